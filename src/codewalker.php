@@ -367,7 +367,7 @@ elseif ($view === 'actions') {
     echo '<div class="card"><form method="get" class="grid" style="display:grid;grid-template-columns:repeat(6,1fr);gap:.5rem">';
     echo '<input type="hidden" name="view" value="actions">';
     echo '<select name="kind"><option value="all"'.($kind==='all'?' selected':'').'>all</option><option value="summarize"'.($kind==='summarize'?' selected':'').'>summarize</option><option value="rewrite"'.($kind==='rewrite'?' selected':'').'>rewrite</option></select>';
-    echo '<select name="status"><option value="all"'.($status==='all'?' selected':'').'>all</option><option value="ok"'.($status==='ok'?' selected':'').'>ok</option><option value="error"'.($status==='error'?' selected':'').'>error</option></select>';
+    echo '<select name="status"><option value="all"'.($status==='all'?' selected':'').'>all</option><option value="ok"'.($status==='ok'?' selected':'').'>ok</option><option value="error"'.($status==='error'?' selected':'').'>error</option><option value="dedup"'.($status==='dedup'?' selected':'').'>dedup</option></select>';
     echo '<input type="text" name="q" placeholder="path contains…" value="'.h($q).'">';
     echo '<input type="number" name="limit" min="1" max="500" value="'.(int)$limit.'">';
     echo '<button class="btn" type="submit">Filter</button>';
@@ -428,6 +428,9 @@ elseif ($view === 'action') {
     echo '<div class="kv"><div>File</div><div style="max-width:900px">'.h($a['path']).' <a class="badge" href="'.$mc_link.'">Open in MC</a></div></div>';
         echo '<div class="kv"><div>Model</div><div>'.h(($a['backend']?:'').'/'.($a['model']?:'')).'</div></div>';
         echo '<div class="kv"><div>When</div><div>'.h($a['created_at']).'</div></div>';
+        if (!empty($a['dedup_of'])) {
+            echo '<div class="kv"><div>Dedup of</div><div>Identical content; result stored on <a class="btn" href="?view=action&id='.(int)$a['dedup_of'].'">#'.(int)$a['dedup_of'].'</a></div></div>';
+        }
         echo '<details style="margin-top:.5rem"><summary>Prompt</summary><pre>'.h($a['prompt']).'</pre></details>';
         if ($a['action']==='summarize') {
             $s = $pdo->prepare('SELECT summary FROM summaries WHERE action_id=?'); $s->execute([$id]); $row=$s->fetch();
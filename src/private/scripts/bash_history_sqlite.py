@@ -1,22 +1,89 @@
 #!/usr/bin/env python3
-"""Store bash history entries in a SQLite database.
+"""Store shell history entries in a SQLite database.
 
 This script mirrors the behaviour of the original `bash_history_sqlite.sh`
-Bash script. It keeps track of how many lines from the history file have been
-processed for a given host/path pair, appending only newly added commands into
-`bash_history` and updating `history_state` accordingly.
+Bash script. It keeps track of how far into each history file it has read for a
+given host/path pair, appending only newly added commands into `bash_history`
+and updating `history_state` accordingly.
+
+By default only the invoking user's `HISTFILE` is read. `--all-users` collects
+bash, zsh and fish histories for /root and /home/* in one pass (plus any
+`--glob`), and `--remote DIR` ingests histories pulled from other hosts laid
+out as DIR/<host>/root/..., DIR/<host>/home/<user>/... . Re-pulling those
+files (rsync/scp replace them by rename) only ingests what was appended since
+the previous pull. Timestamps come from
+HISTTIMEFORMAT `#epoch` lines, zsh extended history and fish `when:` fields;
+entries without one are stamped with the ingestion time.
+
+Queries: `--search QUERY` (FTS5 over `command`, newest first) and `--top`
+(per-host counts from the deduplicated `commands` table), both filterable by
+`--host` and `--since`.
+
+`--follow` keeps running and ingests new commands within a second or two of the
+shell flushing them. It watches the history files' directories with inotify
+(polling stat() where inotify is unavailable), so rotation or recreation of a
+file is seen like any other write. It reuses one WAL connection and commits one
+small transaction per batch of changed files.
+
+Progress is stored as a byte offset plus a checksum of the bytes just before
+it, so each run seeks straight to the new data. A file shorter than the offset
+or a checksum mismatch (file rewritten) restarts ingestion from the beginning.
+A file replaced by rename with the same prefix resumes like an appended one.
 """
 from __future__ import annotations
 
+import argparse
+import ctypes
+import ctypes.util
+import getpass
+import glob
+import hashlib
 import os
+import re
+import select
+import signal
 import socket
 import sqlite3
+import struct
+import sys
+import time
 from pathlib import Path
-from typing import Tuple
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
 DB_PATH = Path("/var/www/html/admin/php_mc/src/private/db/bash_history.db")
 DEFAULT_HISTORY = Path("~/.bash_history").expanduser()
 
+# Bytes before the stored offset that are hashed to detect rewrites.
+CHECKSUM_WINDOW = 4096
+READ_CHUNK = 1 << 16
+
+# (shell, pattern relative to a filesystem root) searched by --all-users / --remote
+HISTORY_GLOBS = [
+    ("bash", "root/.bash_history"),
+    ("zsh", "root/.zsh_history"),
+    ("fish", "root/.local/share/fish/fish_history"),
+    ("bash", "home/*/.bash_history"),
+    ("zsh", "home/*/.zsh_history"),
+    ("fish", "home/*/.local/share/fish/fish_history"),
+]
+
+# A parsed history entry: (resume offset after it, epoch seconds or None, command)
+Record = Tuple[int, Optional[int], str]
+
+
+class HistorySource(NamedTuple):
+    host: str
+    user: str
+    shell: str
+    path: Path
+
+
+class HistoryState(NamedTuple):
+    inode: str
+    last_line: int
+    byte_offset: int | None
+    checksum: str
+
 
 def ensure_tables(connection: sqlite3.Connection) -> None:
     connection.executescript(
@@ -37,6 +104,107 @@ def ensure_tables(connection: sqlite3.Connection) -> None:
         );
         """
     )
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(history_state)")}
+    if "byte_offset" not in columns:
+        connection.execute("ALTER TABLE history_state ADD COLUMN byte_offset INTEGER")
+    if "checksum" not in columns:
+        connection.execute("ALTER TABLE history_state ADD COLUMN checksum TEXT")
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(bash_history)")}
+    if "user" not in columns:
+        connection.execute("ALTER TABLE bash_history ADD COLUMN user TEXT")
+    if "shell" not in columns:
+        connection.execute("ALTER TABLE bash_history ADD COLUMN shell TEXT")
+    connection.executescript(
+        """
+        CREATE INDEX IF NOT EXISTS idx_bash_history_host_ts ON bash_history(host, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_bash_history_ts ON bash_history(timestamp);
+        """
+    )
+    ensure_commands(connection)
+    ensure_fts(connection)
+
+
+def normalize_command(command: str) -> str:
+    """Key for the `commands` table: whitespace-collapsed command text."""
+    return " ".join(command.split())
+
+
+def ensure_commands(connection: sqlite3.Connection) -> None:
+    """Deduplicated per-host command counts, maintained by ingest_file."""
+    if connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='commands'"
+    ).fetchone():
+        return
+    connection.executescript(
+        """
+        CREATE TABLE commands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            host TEXT NOT NULL,
+            command TEXT NOT NULL,
+            count INTEGER DEFAULT 0,
+            first_seen TEXT,
+            last_seen TEXT,
+            UNIQUE (host, command)
+        );
+        CREATE INDEX idx_commands_count ON commands(count DESC);
+        """
+    )
+    # Backfill from existing history in one pass
+    rows = connection.execute("SELECT host, command, timestamp FROM bash_history")
+    upsert_commands(
+        connection,
+        ((host or "", normalize_command(command or ""), ts) for host, command, ts in rows),
+    )
+
+
+def upsert_commands(
+    connection: sqlite3.Connection, rows: Iterable[Tuple[str, str, Optional[str]]]
+) -> None:
+    connection.executemany(
+        """
+        INSERT INTO commands (host, command, count, first_seen, last_seen)
+        VALUES (?, ?, 1, COALESCE(?3, datetime('now')), COALESCE(?3, datetime('now')))
+        ON CONFLICT(host, command) DO UPDATE SET
+            count = count + 1,
+            first_seen = MIN(first_seen, excluded.first_seen),
+            last_seen = MAX(last_seen, excluded.last_seen);
+        """,
+        (row for row in rows if row[1]),
+    )
+
+
+def ensure_fts(connection: sqlite3.Connection) -> bool:
+    """FTS5 index over bash_history.command, kept in sync by triggers.
+    Returns False if this SQLite build has no FTS5 (search falls back to LIKE)."""
+    if connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE name='bash_history_fts'"
+    ).fetchone():
+        return True
+    try:
+        connection.executescript(
+            """
+            CREATE VIRTUAL TABLE bash_history_fts USING fts5(
+                command, content='bash_history', content_rowid='id'
+            );
+            CREATE TRIGGER IF NOT EXISTS bash_history_ai AFTER INSERT ON bash_history BEGIN
+                INSERT INTO bash_history_fts(rowid, command) VALUES (new.id, new.command);
+            END;
+            CREATE TRIGGER IF NOT EXISTS bash_history_ad AFTER DELETE ON bash_history BEGIN
+                INSERT INTO bash_history_fts(bash_history_fts, rowid, command)
+                VALUES ('delete', old.id, old.command);
+            END;
+            CREATE TRIGGER IF NOT EXISTS bash_history_au AFTER UPDATE OF command ON bash_history BEGIN
+                INSERT INTO bash_history_fts(bash_history_fts, rowid, command)
+                VALUES ('delete', old.id, old.command);
+                INSERT INTO bash_history_fts(rowid, command) VALUES (new.id, new.command);
+            END;
+            INSERT INTO bash_history_fts(bash_history_fts) VALUES ('rebuild');
+            """
+        )
+    except sqlite3.OperationalError as exc:
+        print(f"FTS5 unavailable, search uses LIKE: {exc}", file=sys.stderr)
+        return False
+    return True
 
 
 def resolve_history_file() -> Path:
@@ -48,10 +216,10 @@ def resolve_history_file() -> Path:
 
 def load_state(
     connection: sqlite3.Connection, host: str, histfile: Path
-) -> Tuple[str, int]:
+) -> HistoryState:
     cursor = connection.execute(
         """
-        SELECT COALESCE(inode, ""), COALESCE(last_line, 0)
+        SELECT COALESCE(inode, ""), COALESCE(last_line, 0), byte_offset, COALESCE(checksum, "")
         FROM history_state
         WHERE host = ? AND path = ?
         LIMIT 1;
@@ -60,9 +228,14 @@ def load_state(
     )
     row = cursor.fetchone()
     if not row:
-        return "", 0
-    inode, last_line = row
-    return str(inode) if inode is not None else "", int(last_line or 0)
+        return HistoryState("", 0, None, "")
+    inode, last_line, byte_offset, checksum = row
+    return HistoryState(
+        str(inode) if inode is not None else "",
+        int(last_line or 0),
+        int(byte_offset) if byte_offset is not None else None,
+        str(checksum),
+    )
 
 
 def update_state(
@@ -71,69 +244,562 @@ def update_state(
     histfile: Path,
     inode: str,
     last_line: int,
+    byte_offset: int,
+    checksum: str,
 ) -> None:
     connection.execute(
         """
-        INSERT INTO history_state(host, path, inode, last_line, updated_at)
-        VALUES(?, ?, ?, ?, datetime('now'))
+        INSERT INTO history_state(host, path, inode, last_line, byte_offset, checksum, updated_at)
+        VALUES(?, ?, ?, ?, ?, ?, datetime('now'))
         ON CONFLICT(host, path) DO UPDATE SET
             inode = excluded.inode,
             last_line = excluded.last_line,
+            byte_offset = excluded.byte_offset,
+            checksum = excluded.checksum,
             updated_at = excluded.updated_at;
         """,
-        (host, str(histfile), inode, last_line),
+        (host, str(histfile), inode, last_line, byte_offset, checksum),
     )
 
 
-def process_history(connection: sqlite3.Connection) -> None:
-    host = socket.gethostname()
-    histfile = resolve_history_file()
+def window_checksum(handle, offset: int) -> str:
+    """Hash the CHECKSUM_WINDOW bytes that end at `offset`."""
+    start = max(0, offset - CHECKSUM_WINDOW)
+    handle.seek(start)
+    return hashlib.sha1(handle.read(offset - start)).hexdigest()
 
-    if not histfile.exists():
-        return
 
-    stats = histfile.stat()
-    inode = str(getattr(stats, "st_ino", ""))
+def offset_after_lines(handle, line_count: int) -> int | None:
+    """Byte offset just past `line_count` lines (legacy state migration), or None
+    if the file has fewer lines than that."""
+    handle.seek(0)
+    seen = 0
+    for seen, _ in enumerate(handle, start=1):
+        if seen == line_count:
+            return handle.tell()
+    return 0 if line_count == 0 else None
 
-    old_inode, last_line = load_state(connection, host, histfile)
 
-    with histfile.open("r", encoding="utf-8", errors="replace") as handle:
-        lines = [line.rstrip("\n") for line in handle]
+def resume_offset(handle, state: HistoryState, inode: str, size: int) -> int:
+    """Where to resume reading: the stored offset if the file still holds the same
+    bytes before it (only appended data), otherwise 0.
 
-    line_count = len(lines)
+    Size and checksum decide. The inode is not required to match, since rsync/scp
+    pulls, some editors and `history -w` replace the file via rename; it is only
+    trusted for state from the line-based version, which has no checksum.
+    """
+    if state.byte_offset is None:
+        if not state.inode or state.inode != inode:
+            return 0
+        # State written by the line-based version: convert once
+        offset = offset_after_lines(handle, state.last_line)
+        return offset if offset is not None else 0
+    if state.byte_offset > size:
+        return 0  # truncated
+    if window_checksum(handle, state.byte_offset) != state.checksum:
+        return 0  # rewritten (e.g. history -w after erasedups)
+    return state.byte_offset
 
-    if old_inode and old_inode == inode and line_count >= last_line:
-        start_index = max(last_line, 0)
-    else:
-        start_index = 0
 
-    if start_index >= line_count:
-        new_commands: list[str] = []
-    else:
-        new_commands = lines[start_index:]
+def read_new_lines(handle, offset: int) -> Iterator[Tuple[int, str]]:
+    """Stream complete lines after `offset`, yielding (end_offset, line).
+    A trailing line without a newline is left for the next run."""
+    handle.seek(offset)
+    pending = b""
+    position = offset
+    while True:
+        chunk = handle.read(READ_CHUNK)
+        if not chunk:
+            break
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for raw in lines:
+            position += len(raw) + 1
+            yield position, raw.decode("utf-8", errors="replace")
+
+
+BASH_TS_RE = re.compile(r"^#(\d{9,11})$")
+ZSH_EXT_RE = re.compile(r"^: (\d+):\d+;(.*)$", re.DOTALL)
+
+
+def parse_bash(lines: Iterable[Tuple[int, str]]) -> Iterator[Record]:
+    """Plain bash history; `#epoch` lines (HISTTIMEFORMAT) stamp the next command.
+    A trailing `#epoch` without its command is not consumed."""
+    stamp: Optional[int] = None
+    for end, line in lines:
+        match = BASH_TS_RE.match(line)
+        if match:
+            stamp = int(match.group(1))
+            continue
+        yield end, stamp, line
+        stamp = None
+
+
+def parse_zsh(lines: Iterable[Tuple[int, str]]) -> Iterator[Record]:
+    """zsh history, plain or EXTENDED_HISTORY (`: epoch:duration;command`).
+    Multi-line commands end their continued lines with a backslash."""
+    buffer: List[str] = []
+    for end, line in lines:
+        buffer.append(line)
+        if line.endswith("\\"):
+            buffer[-1] = line[:-1]
+            continue
+        text = "\n".join(buffer)
+        buffer = []
+        match = ZSH_EXT_RE.match(text)
+        if match:
+            yield end, int(match.group(1)), match.group(2)
+        else:
+            yield end, None, text
+
+
+FISH_ESCAPE_RE = re.compile(r"\\(.)")
+
+
+def _fish_unescape(value: str) -> str:
+    return FISH_ESCAPE_RE.sub(lambda m: "\n" if m.group(1) == "n" else m.group(1), value)
+
+
+def parse_fish(lines: Iterable[Tuple[int, str]]) -> Iterator[Record]:
+    """fish_history pseudo-YAML: `- cmd: ...` then indented `when:` / `paths:`."""
+    current: Optional[List] = None  # [end, when, cmd]
+    for end, line in lines:
+        if line.startswith("- cmd: "):
+            if current:
+                yield current[0], current[1], current[2]
+            current = [end, None, _fish_unescape(line[len("- cmd: "):])]
+            continue
+        if current is None:
+            continue
+        current[0] = end
+        stripped = line.strip()
+        if stripped.startswith("when: ") and stripped[6:].isdigit():
+            current[1] = int(stripped[6:])
+    if current:
+        yield current[0], current[1], current[2]
+
+
+PARSERS: dict = {"bash": parse_bash, "zsh": parse_zsh, "fish": parse_fish}
+
+
+def guess_shell(path: Path) -> str:
+    name = path.name.lower()
+    if "zsh" in name:
+        return "zsh"
+    if "fish" in name:
+        return "fish"
+    return "bash"
+
+
+def owner_of(path: Path, root: Path) -> str:
+    """User a history file belongs to: home/<user>/..., root/..., else the file owner."""
+    try:
+        parts = path.relative_to(root).parts
+        if len(parts) > 1 and parts[0] == "home":
+            return parts[1]
+        if parts and parts[0] == "root":
+            return "root"
+    except ValueError:
+        pass
+    try:
+        import pwd
 
-    if new_commands:
+        return pwd.getpwuid(path.stat().st_uid).pw_name
+    except Exception:
+        return ""
+
+
+def discover_sources(
+    root: Path, host: str, extra_globs: Iterable[str] = (), defaults: bool = True
+) -> List[HistorySource]:
+    """All history files under `root` (a filesystem root or a pulled host dir)."""
+    found: dict = {}
+    patterns = [(shell, str(root / rel)) for shell, rel in HISTORY_GLOBS] if defaults else []
+    patterns += [(None, pattern) for pattern in extra_globs]
+    for shell, pattern in patterns:
+        for match in sorted(glob.glob(pattern)):
+            path = Path(match)
+            if path.is_file() and path not in found:
+                found[path] = HistorySource(
+                    host, owner_of(path, root), shell or guess_shell(path), path
+                )
+    return list(found.values())
+
+
+def format_timestamp(epoch: Optional[int]) -> Optional[str]:
+    """Same format as SQLite datetime('now') (UTC)."""
+    if epoch is None:
+        return None
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(epoch))
+
+
+def ingest_file(connection: sqlite3.Connection, source: HistorySource) -> int:
+    """Append new entries of one history file; returns the number inserted."""
+    stats = source.path.stat()
+    inode = str(getattr(stats, "st_ino", ""))
+
+    state = load_state(connection, source.host, source.path)
+    parser: Callable[[Iterable[Tuple[int, str]]], Iterator[Record]] = PARSERS.get(
+        source.shell, parse_bash
+    )
+
+    with source.path.open("rb") as handle:
+        start = resume_offset(handle, state, inode, stats.st_size)
+        last_line = state.last_line if start else 0
+        end = start
+        rows: List[Tuple[str, Optional[str], str, str, str]] = []
+        for end, epoch, command in parser(read_new_lines(handle, start)):
+            rows.append(
+                (source.host, format_timestamp(epoch), command, source.user, source.shell)
+            )
+        checksum = window_checksum(handle, end)
+
+    if rows:
         connection.executemany(
             """
-            INSERT INTO bash_history (host, timestamp, command)
-            VALUES (?, datetime('now'), ?);
+            INSERT INTO bash_history (host, timestamp, command, user, shell)
+            VALUES (?, COALESCE(?, datetime('now')), ?, ?, ?);
             """,
-            ((host, command) for command in new_commands),
+            rows,
+        )
+        upsert_commands(
+            connection, ((host, normalize_command(command), ts) for host, ts, command, _, _ in rows)
         )
 
-    update_state(connection, host, histfile, inode, line_count)
+    update_state(
+        connection, source.host, source.path, inode, last_line + len(rows), end, checksum
+    )
+    return len(rows)
 
 
-def main() -> None:
+def process_history(connection: sqlite3.Connection) -> None:
+    """Ingest the invoking user's HISTFILE (the original single-file behaviour)."""
     histfile = resolve_history_file()
+
     if not histfile.exists():
         return
 
-    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    ingest_file(
+        connection,
+        HistorySource(socket.gethostname(), getpass.getuser(), guess_shell(histfile), histfile),
+    )
+
+
+def parse_since(value: Optional[str]) -> Optional[str]:
+    """'7d' / '12h' relative to now, or an absolute 'YYYY-MM-DD[ HH:MM:SS]' (UTC)."""
+    if not value:
+        return None
+    match = re.fullmatch(r"(\d+)([dhm])", value.strip())
+    if match:
+        seconds = int(match.group(1)) * {"d": 86400, "h": 3600, "m": 60}[match.group(2)]
+        return format_timestamp(int(time.time()) - seconds)
+    return value.strip()
+
+
+def fts_literal(query: str) -> str:
+    """Quote each whitespace-separated term as an FTS5 prefix query ('"st"*'), so
+    'ls /tmp' or 'push -f' are not parsed as FTS5 operators and 'st' still finds
+    'git status'."""
+    return " ".join('"' + term.replace('"', '""') + '"*' for term in query.split())
+
+
+def search_history(
+    connection: sqlite3.Connection,
+    query: str,
+    host: Optional[str] = None,
+    since: Optional[str] = None,
+    limit: int = 20,
+    raw: bool = False,
+) -> List[Tuple[str, str, str, str]]:
+    """Most recent matches first: [(timestamp, host, user, command)].
+    Every term of `query` must start a word of the command (prefix match on FTS
+    tokens, not an arbitrary substring); with raw=True it is FTS5 syntax instead
+    (e.g. '"systemctl restart"', 'docker*', 'rsync NOT dry')."""
+    filters, params = [], []
+    if host:
+        filters.append("h.host = ?")
+        params.append(host)
+    if since:
+        filters.append("h.timestamp >= ?")
+        params.append(since)
+    where = "".join(f" AND {f}" for f in filters)
+    match = query if raw else fts_literal(query)
+    if match.strip() and ensure_fts(connection):
+        query = match
+        sql = (
+            "SELECT h.timestamp, h.host, COALESCE(h.user, ''), h.command FROM bash_history h "
+            f"WHERE h.id IN (SELECT rowid FROM bash_history_fts WHERE bash_history_fts MATCH ?){where} "
+            "ORDER BY h.timestamp DESC, h.id DESC LIMIT ?"
+        )
+    else:
+        sql = (
+            "SELECT h.timestamp, h.host, COALESCE(h.user, ''), h.command FROM bash_history h "
+            f"WHERE h.command LIKE '%' || ? || '%'{where} ORDER BY h.timestamp DESC, h.id DESC LIMIT ?"
+        )
+    return connection.execute(sql, [query, *params, limit]).fetchall()
+
+
+def top_commands(
+    connection: sqlite3.Connection,
+    host: Optional[str] = None,
+    since: Optional[str] = None,
+    limit: int = 20,
+) -> List[Tuple[int, str]]:
+    """[(count, command)]. All-time counts come from `commands`; a `since` window
+    aggregates the (timestamp-indexed) range of bash_history instead."""
+    if since:
+        sql = "SELECT COUNT(*) AS n, command FROM bash_history WHERE timestamp >= ?"
+        params: list = [since]
+        if host:
+            sql += " AND host = ?"
+            params.append(host)
+        rows = connection.execute(sql + " GROUP BY command", params).fetchall()
+        merged: dict = {}
+        for count, command in rows:
+            key = normalize_command(command or "")
+            if key:
+                merged[key] = merged.get(key, 0) + count
+        return sorted(((n, c) for c, n in merged.items()), reverse=True)[:limit]
+    sql = "SELECT SUM(count) AS n, command FROM commands"
+    params = []
+    if host:
+        sql += " WHERE host = ?"
+        params.append(host)
+    sql += " GROUP BY command ORDER BY n DESC LIMIT ?"
+    return connection.execute(sql, [*params, limit]).fetchall()
+
+
+def collect_sources(args: argparse.Namespace) -> List[HistorySource]:
+    if not (args.all_users or args.glob or args.remote):
+        histfile = resolve_history_file()
+        if not histfile.exists() and not getattr(args, "follow", False):
+            return []
+        return [HistorySource(socket.gethostname(), getpass.getuser(), guess_shell(histfile), histfile)]
+
+    sources: List[HistorySource] = []
+    if args.all_users or args.glob:
+        sources += discover_sources(
+            Path("/"), socket.gethostname(), args.glob or [], defaults=args.all_users
+        )
+    for remote in args.remote or []:
+        base = Path(remote)
+        if not base.is_dir():
+            continue
+        for host_dir in sorted(p for p in base.iterdir() if p.is_dir()):
+            sources += discover_sources(host_dir, host_dir.name)
+    return sources
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """Minimal inotify(7) directory watcher over ctypes (Linux only)."""
+
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self) -> None:
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches: dict = {}  # wd -> directory
+
+    def watch(self, directory: str) -> None:
+        if directory in self.watches.values():
+            return
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch {directory} failed")
+        self.watches[wd] = directory
+
+    def read(self, timeout: float) -> Optional[set]:
+        """Paths touched within `timeout` seconds; None means the kernel queue
+        overflowed and every watched file should be treated as changed."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        paths: set = set()
+        pos = 0
+        while pos + INOTIFY_EVENT.size <= len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, pos)
+            pos += INOTIFY_EVENT.size
+            name = data[pos:pos + length].rstrip(b"\0")
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)  # directory removed
+            elif wd in self.watches and name:
+                paths.add(os.path.join(self.watches[wd], os.fsdecode(name)))
+        return paths
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def file_signature(path: Path) -> Optional[Tuple[int, int, int]]:
+    try:
+        stats = path.stat()
+    except OSError:
+        return None
+    return stats.st_ino, stats.st_size, stats.st_mtime_ns
+
+
+def ingest_batch(connection: sqlite3.Connection, sources: Iterable[HistorySource]) -> int:
+    """Ingest several files in one transaction; missing files are skipped
+    (a rotated file is picked up again once it is recreated)."""
+    total = 0
+    with connection:
+        for source in sources:
+            try:
+                total += ingest_file(connection, source)
+            except FileNotFoundError:
+                continue
+            except OSError as exc:
+                print(f"skip {source.path}: {exc}", file=sys.stderr)
+    return total
+
+
+def follow(
+    connection: sqlite3.Connection,
+    args: argparse.Namespace,
+    batch_window: float = 1.0,
+    poll_interval: float = 2.0,
+    rescan_interval: float = 300.0,
+) -> None:
+    """Tail history files until SIGINT/SIGTERM.
+
+    Events are coalesced for `batch_window` seconds so a shell flushing
+    several lines (or several shells exiting together) costs one commit.
+    Sources are rediscovered every `rescan_interval` seconds to pick up new
+    users and pulled hosts."""
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        notifier: Optional[Inotify] = Inotify()
+    except OSError as exc:
+        print(f"inotify unavailable ({exc}), polling every {poll_interval}s", file=sys.stderr)
+        notifier = None
+
+    sources: dict = {}
+    signatures: dict = {}
+    next_rescan = 0.0
+    try:
+        while True:
+            if time.monotonic() >= next_rescan:
+                sources = {str(source.path): source for source in collect_sources(args)}
+                if notifier:
+                    for directory in {os.path.dirname(path) for path in sources}:
+                        try:
+                            notifier.watch(directory)
+                        except OSError as exc:
+                            print(f"watch {directory}: {exc}", file=sys.stderr)
+                signatures = {path: file_signature(Path(path)) for path in sources}
+                ingest_batch(connection, sources.values())  # catch up
+                next_rescan = time.monotonic() + rescan_interval
+
+            if notifier:
+                touched = notifier.read(max(0.0, next_rescan - time.monotonic()))
+                if touched == set():
+                    continue
+                deadline = time.monotonic() + batch_window
+                while touched is not None and time.monotonic() < deadline:
+                    more = notifier.read(max(0.0, deadline - time.monotonic()))
+                    touched = None if more is None else touched | more
+                changed = list(sources) if touched is None else [p for p in touched if p in sources]
+            else:
+                time.sleep(poll_interval)
+                changed = []
+                for path in sources:
+                    signature = file_signature(Path(path))
+                    if signature != signatures.get(path):
+                        signatures[path] = signature
+                        changed.append(path)
+
+            if changed:
+                ingest_batch(connection, (sources[path] for path in changed))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if notifier:
+            notifier.close()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Store shell history in SQLite")
+    parser.add_argument("--db", default=str(DB_PATH), help="SQLite database path")
+    parser.add_argument("--all-users", action="store_true", help="Collect bash/zsh/fish history of /root and /home/*")
+    parser.add_argument("--glob", action="append", help="Extra history file glob (repeatable)")
+    parser.add_argument("--remote", action="append", help="Directory of pulled histories: DIR/<host>/{root,home/<user>}/... (re-pull freely; only new lines are added)")
+    parser.add_argument("--search", metavar="QUERY", help="Search commands with a word starting with each term (e.g. 'st' finds 'git status'), newest first")
+    parser.add_argument("--fts", action="store_true", help="Treat --search as raw FTS5 syntax (phrases, prefix*, AND/OR/NOT)")
+    parser.add_argument("--top", action="store_true", help="Most frequent commands")
+    parser.add_argument("--host", help="Restrict --search/--top to one host")
+    parser.add_argument("--since", help="Restrict --search/--top to entries after '7d', '12h' or a UTC date")
+    parser.add_argument("--limit", type=int, default=20, help="Rows for --search/--top")
+    parser.add_argument("--follow", action="store_true", help="Keep running and ingest new commands as they are written")
+    parser.add_argument("--batch-window", type=float, default=1.0, help="--follow: seconds to coalesce writes into one commit")
+    parser.add_argument("--poll", type=float, default=2.0, help="--follow: stat() interval when inotify is unavailable")
+    args = parser.parse_args(argv)
+
+    if args.search or args.top:
+        with sqlite3.connect(args.db) as connection:
+            ensure_tables(connection)
+            since = parse_since(args.since)
+            if args.search:
+                try:
+                    rows = search_history(connection, args.search, args.host, since, args.limit, args.fts)
+                except sqlite3.OperationalError as exc:
+                    parser.error(f"invalid --fts query {args.search!r}: {exc}")
+                for ts, host, user, command in rows:
+                    print(f"{ts}  {host:<12} {user:<10} {command}")
+            else:
+                for count, command in top_commands(connection, args.host, since, args.limit):
+                    print(f"{count:>7}  {command}")
+        return
+
+    db_path = Path(args.db)
+
+    if args.follow:
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(db_path, timeout=30)
+        try:
+            # WAL so --search and other readers are never blocked by the tailer
+            connection.execute("PRAGMA journal_mode=WAL")
+            ensure_tables(connection)
+            connection.commit()
+            follow(connection, args, batch_window=args.batch_window, poll_interval=args.poll)
+        finally:
+            connection.close()
+        return
+
+    sources = collect_sources(args)
+    if not sources:
+        return
+
+    db_path.parent.mkdir(parents=True, exist_ok=True)
 
-    with sqlite3.connect(DB_PATH) as connection:
+    # One connection and one transaction for every file
+    with sqlite3.connect(db_path) as connection:
         ensure_tables(connection)
-        process_history(connection)
+        for source in sources:
+            try:
+                ingest_file(connection, source)
+            except OSError as exc:
+                print(f"skip {source.path}: {exc}", file=sys.stderr)
         connection.commit()
 
 
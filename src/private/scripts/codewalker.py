@@ -8,6 +8,20 @@ CodeWalker — cron‑safe AI code & log walker for /web on .152
 • Unified diffs captured for rewrites to review/apply later
 • Designed to prefer local LLMs (LM Studio or Ollama), with OpenAI‑compatible fallback
 • Uses lockfile to avoid overlapping cron runs
+• --maintain prunes old history (see "retention"), rolling it into daily_rollup first
+• Identical content at several paths is sent to the model once (dedup rows link to the result)
+• Timeouts adapt to observed latency; retryable HTTP errors back off and retry; optional hedging
+• Idle cron ticks (empty queue, unchanged change_marker) exit in milliseconds without writing
+• --plan estimates the next run and backlog drain time from history and suggests a limit
+• "routes" pick model/backend/num_ctx per action, extension and payload size
+• --search "QUERY" ranks summaries/rewrites/paths via an FTS5 index kept in sync by triggers
+• Optional "embeddings" stage + --similar PATH / --similar-text TEXT cosine search (numpy)
+• "incremental_rewrite": when a file changed since its last successful action, only the changed
+  functions/classes (plus a few context lines) are sent for rewrite and spliced back into the file
+• --export PATH / --import PATH stream results as gzipped NDJSON; exports resume from the
+  last exported action id, imports skip rows already present, so several hosts can be merged
+• "deterministic_per_file": paths hash into stable shards, one shard per run in rotation, so
+  the whole tree is covered in a bounded number of runs; concurrent walkers claim disjoint shards
 
 Quick start (suggested):
   1) Save config to /var/www/html/admin/php_mc/src/private/codewalker.json (see CONFIG_TEMPLATE below)
@@ -29,12 +43,17 @@ Optional: python-dotenv (auto fallback to simple .env loader)
 """
 from __future__ import annotations
 import argparse
+import ast
+import collections
 import datetime as dt
 import difflib
 import fnmatch
+import gzip
 import hashlib
+import heapq
 import json
 import logging
+import math
 import os
 import random
 import re
@@ -44,21 +63,14 @@ import socket
 import sqlite3
 import sys
 import time
+import zlib
 from pathlib import Path
+from typing import Iterable, Iterator
 
-# Third‑party
-try:
-    import requests
-except ImportError:
-    print("[CodeWalker] Missing dependency: requests\n  pip install requests", file=sys.stderr)
-    sys.exit(2)
-
-# Optional .env support
-try:
-    from dotenv import load_dotenv  # type: ignore
-    _HAS_DOTENV = True
-except Exception:
-    _HAS_DOTENV = False
+# Third‑party modules are imported lazily (see load_requests / load_numpy / load_env)
+# so an idle cron tick can exit before paying for them.
+requests = None
+np = None
 
 APP_NAME = "CodeWalker"
 VERSION = "1.0.0"
@@ -104,10 +116,78 @@ CONFIG_TEMPLATE = {
     "base_url": None,   # if backend==custom or openai_compat
     "api_key": None,              # if your endpoint needs a key
     "model": "gemma3:4b",
+    "ollama_model": "gemma3:4b",  # model used when "auto" falls back to Ollama
+    "num_ctx": None,              # context size sent to Ollama (options.num_ctx)
+    # Routing rules, first match wins. Match keys: action, ext, min_tokens, max_tokens
+    # (estimated payload tokens). Override keys: model, backend, base_url, num_ctx.
+    # e.g. [{"action": "summarize", "ext": ["log"], "model": "gemma3:4b", "backend": "ollama", "num_ctx": 8192},
+    #       {"action": "summarize", "max_tokens": 2000, "model": "gemma3:4b", "backend": "ollama", "num_ctx": 4096},
+    #       {"action": "rewrite", "model": "openai/gpt-oss-20b", "num_ctx": 34816}]
+    "routes": [],
     "percent_rewrite": 50,        # % chance a chosen action is rewrite (vs summarize)
     "limit_per_run": 5,
+    "cron_interval_min": 20,      # used by --plan to size limit_per_run
     "lockfile": "/tmp/codewalker.lock",
     "respect_gitignore": True,
+    "walk_threads": 8,            # parallel directory listings (helps on NFS/SSHFS)
+    "scan_order": "random",       # random (reservoir sample) | walk (first files found, fully lazy)
+    # Shard mode (overrides scan_order): each path hashes into one of `shards` stable shards and
+    # every run takes the next shard, so each file is visited once per rotation. A shard larger
+    # than limit_per_run is resumed where the previous run stopped.
+    "deterministic_per_file": False,
+    "shards": 0,                  # 0 = size once as ceil(candidates / limit_per_run), then keep it
+    "shard_claim_ttl_min": 180,   # a claim older than this (crashed walker) is taken over
+    "sample_weight": "uniform",   # uniform | recent (newer mtime) | small (smaller files)
+    "sample_factor": 3,           # reservoir holds limit_per_run × this, to cover skipped files
+    "dedup_content": True,        # reuse an ok result from another path with identical content
+    # Scan mode only: file whose mtime marks "tree changed" (e.g. touched by a deploy hook).
+    # When set, cron ticks with no pending queue and an unchanged marker exit immediately.
+    # The marker counts as seen only after every new/changed file has been visited.
+    "change_marker": None,
+    # LLM HTTP policy: timeouts scale with observed p95 latency per token and payload size
+    "http": {
+        "timeout_default_s": {"lmstudio": 900, "ollama": 180, "openai_compat": 180},  # used until min_samples
+        "timeout_min_s": 30,
+        "timeout_max_s": 900,
+        "timeout_factor": 3.0,        # timeout = factor × expected p95 latency
+        "min_samples": 20,
+        "retries": 2,
+        "retry_statuses": [408, 425, 429, 500, 502, 503, 504],
+        "backoff_base_s": 2,
+        "backoff_max_s": 30,
+        "hedge_base_url": None,       # optional second endpoint, raced once a request passes its p95
+        "hedge_min_s": 5,
+    },
+    # Rewrite only what changed since the file's last successful action. Needs a stored copy of
+    # that version (file_snapshots, one zlib-compressed row per file, written while enabled).
+    "incremental_rewrite": {
+        "enabled": False,
+        "context_lines": 3,           # read-only lines shown around each region
+        "max_changed_ratio": 0.6,     # above this share of changed lines, rewrite the whole file
+        "max_regions": 12,
+    },
+    # Optional embedding stage for summaries (needs numpy); vectors go to <db>.vec
+    "embeddings": {
+        "enabled": False,
+        "backend": None,              # defaults to "backend"
+        "base_url": None,             # defaults to "base_url"
+        "model": "nomic-embed-text",
+        "path": None,                 # defaults to db_path with .vec suffix
+        "compact_dead_ratio": 0.25,   # --maintain rewrites the .vec file once this share of rows is unused
+    },
+    # Maintenance (--maintain): prune old history after rolling it into daily_rollup
+    "retention": {
+        "keep_actions_per_file": 10,  # newest N actions per file are always kept
+        "min_age_days": 30,           # only actions older than this are pruned
+        "keep_applied": True,         # never prune rewrites listed in applied_rewrites
+        "batch_size": 2000,           # rows deleted per transaction
+        "vacuum_pages": 1000,         # pages released per incremental_vacuum step
+        "time_budget_s": 30,          # stop pruning/vacuuming after this many seconds
+        # DBs created before auto_vacuum=INCREMENTAL need one full VACUUM to convert. It rewrites
+        # the whole file under an exclusive lock (needs ~2x disk) and ignores time_budget_s, so it
+        # only runs when enabled here; otherwise freed pages are just reused.
+        "convert_auto_vacuum": False,
+    },
 }
 
 ## Legacy prompt pools removed; prompts now sourced solely from prompt.json.
@@ -150,8 +230,37 @@ def load_prompt_list(cfg: dict) -> list[str]:
         logging.warning(f"Failed to load prompts {path}: {e}")
         return [ (cfg.get("rewrite_prompt") or "Make this code more readable and modular.").strip() ]
 
+def load_requests():
+    global requests
+    if requests is None:
+        try:
+            import requests as _requests
+        except ImportError:
+            print("[CodeWalker] Missing dependency: requests\n  pip install requests", file=sys.stderr)
+            sys.exit(2)
+        requests = _requests
+    return requests
+
+
+def load_numpy():
+    """Return numpy, or None if it is not installed (embedding features are optional)."""
+    global np
+    if np is None:
+        try:
+            import numpy as _np  # type: ignore
+        except Exception:
+            return None
+        np = _np
+    return np
+
+
 def load_env():
     """Load .env from /var/www/html/admin/php_mc/src/private/.env if present, without failing if missing."""
+    try:
+        from dotenv import load_dotenv  # type: ignore
+        _HAS_DOTENV = True
+    except Exception:
+        _HAS_DOTENV = False
     env_candidates = [
         "/var/www/html/admin/php_mc/src/private/.env",
         "/var/www/html/admin/php_mc/src/.env",
@@ -229,6 +338,20 @@ def tail_lines(path: str, n: int) -> str:
         return ""
 
 
+def estimate_tokens(text: str) -> int:
+    """Rough token count (≈4 chars/token) for sizing requests before we have usage data."""
+    return len(text) // 4 + 1
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile; 0.0 for an empty list."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, math.ceil(q / 100.0 * len(ordered)) - 1))
+    return float(ordered[k])
+
+
 def unified_diff(a_text: str, b_text: str, a_name: str, b_name: str) -> str:
     a = a_text.splitlines()
     b = b_text.splitlines()
@@ -237,6 +360,7 @@ def unified_diff(a_text: str, b_text: str, a_name: str, b_name: str) -> str:
 # ---------------------- SQLite ----------------------
 
 DDL = r"""
+PRAGMA auto_vacuum=INCREMENTAL;
 PRAGMA journal_mode=WAL;
 CREATE TABLE IF NOT EXISTS files (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -267,8 +391,13 @@ CREATE TABLE IF NOT EXISTS actions (
   tokens_out INTEGER,
   status TEXT,
   error TEXT,
-  created_at TEXT
+  created_at TEXT,
+  latency_ms INTEGER,
+  dedup_of INTEGER
 );
+CREATE INDEX IF NOT EXISTS idx_actions_file ON actions(file_id, id);
+CREATE INDEX IF NOT EXISTS idx_actions_hash ON actions(file_hash, action, status);
+CREATE INDEX IF NOT EXISTS idx_files_hash ON files(last_hash);
 CREATE TABLE IF NOT EXISTS summaries (
   action_id INTEGER PRIMARY KEY,
   summary TEXT
@@ -292,20 +421,193 @@ CREATE TABLE IF NOT EXISTS queued_files (
     notes TEXT,
     status TEXT DEFAULT 'pending'
 );
+CREATE INDEX IF NOT EXISTS idx_queued_status ON queued_files(status);
+CREATE TABLE IF NOT EXISTS applied_rewrites (
+  action_id INTEGER PRIMARY KEY,
+  applied_at TEXT,
+  applied_by TEXT,
+  backup_path TEXT,
+  result TEXT,
+  notes TEXT
+);
+CREATE TABLE IF NOT EXISTS daily_rollup (
+  day TEXT,
+  model TEXT,
+  backend TEXT,
+  action TEXT,
+  actions INTEGER DEFAULT 0,
+  errors INTEGER DEFAULT 0,
+  tokens_in INTEGER DEFAULT 0,
+  tokens_out INTEGER DEFAULT 0,
+  latency_ms_sum INTEGER DEFAULT 0,
+  latency_n INTEGER DEFAULT 0,
+  PRIMARY KEY (day, model, backend, action)
+);
+CREATE VIEW IF NOT EXISTS vw_content_groups AS
+  SELECT last_hash AS content_hash, COUNT(*) AS copies, GROUP_CONCAT(path, char(10)) AS paths
+  FROM files WHERE last_hash IS NOT NULL
+  GROUP BY last_hash HAVING COUNT(*) > 1;
+CREATE TABLE IF NOT EXISTS walker_state (
+  key TEXT PRIMARY KEY,
+  value TEXT,
+  updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS file_snapshots (
+  file_id INTEGER PRIMARY KEY,
+  file_hash TEXT,
+  action_id INTEGER,
+  content BLOB,
+  created_at TEXT
+);
+CREATE TABLE IF NOT EXISTS embeddings (
+  action_id INTEGER PRIMARY KEY,
+  slot INTEGER,
+  dim INTEGER,
+  model TEXT,
+  created_at TEXT
+);
+"""
+
+# Bump whenever DDL/MIGRATIONS/FTS_DDL change; db_connect skips the replay when it matches.
+SCHEMA_VERSION = 4
+
+# Columns added after the first release; db_connect adds them to older DBs.
+MIGRATIONS = [
+    ("actions", "latency_ms", "INTEGER"),
+    ("actions", "dedup_of", "INTEGER"),
+    ("actions", "origin", "TEXT"),  # "<host>:<id>" of an imported action (see import_results)
+]
+
+# Indexes on MIGRATIONS columns, created once those columns exist.
+MIGRATION_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_actions_origin ON actions(origin) WHERE origin IS NOT NULL",
+]
+
+
+# Summary JSON keys flattened into their own FTS columns (see SUMMARIZE_INSTR).
+SUMMARY_FIELDS = [
+    "file_purpose", "key_functions", "inputs_outputs", "dependencies",
+    "side_effects", "risks", "todos", "test_ideas", "raw",
+]
+
+
+def _summary_field_sql(src: str) -> str:
+    return ", ".join(
+        f"CASE WHEN json_valid({src}) THEN json_extract({src}, '$.{k}') END" for k in SUMMARY_FIELDS
+    )
+
+
+# Full-text index, kept in sync by triggers. INSERT OR REPLACE on these tables
+# does not fire delete triggers, so writers must use plain INSERT (fts_summaries
+# tolerates REPLACE; the external-content indexes do not).
+FTS_DDL = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS fts_summaries USING fts5(path, {", ".join(SUMMARY_FIELDS)});
+CREATE VIRTUAL TABLE IF NOT EXISTS fts_rewrites USING fts5(rewrite, content='rewrites', content_rowid='action_id');
+CREATE VIRTUAL TABLE IF NOT EXISTS fts_paths USING fts5(path, content='files', content_rowid='id');
+
+CREATE TRIGGER IF NOT EXISTS trg_summaries_ai AFTER INSERT ON summaries BEGIN
+  DELETE FROM fts_summaries WHERE rowid = NEW.action_id;
+  INSERT INTO fts_summaries(rowid, path, {", ".join(SUMMARY_FIELDS)})
+  VALUES (NEW.action_id,
+          (SELECT f.path FROM actions a JOIN files f ON f.id = a.file_id WHERE a.id = NEW.action_id),
+          {_summary_field_sql("NEW.summary")});
+END;
+CREATE TRIGGER IF NOT EXISTS trg_summaries_ad AFTER DELETE ON summaries BEGIN
+  DELETE FROM fts_summaries WHERE rowid = OLD.action_id;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_summaries_au AFTER UPDATE OF summary ON summaries BEGIN
+  DELETE FROM fts_summaries WHERE rowid = OLD.action_id;
+  INSERT INTO fts_summaries(rowid, path, {", ".join(SUMMARY_FIELDS)})
+  VALUES (NEW.action_id,
+          (SELECT f.path FROM actions a JOIN files f ON f.id = a.file_id WHERE a.id = NEW.action_id),
+          {_summary_field_sql("NEW.summary")});
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_rewrites_ai AFTER INSERT ON rewrites BEGIN
+  INSERT INTO fts_rewrites(rowid, rewrite) VALUES (NEW.action_id, NEW.rewrite);
+END;
+CREATE TRIGGER IF NOT EXISTS trg_rewrites_ad AFTER DELETE ON rewrites BEGIN
+  INSERT INTO fts_rewrites(fts_rewrites, rowid, rewrite) VALUES ('delete', OLD.action_id, OLD.rewrite);
+END;
+CREATE TRIGGER IF NOT EXISTS trg_rewrites_au AFTER UPDATE OF rewrite ON rewrites BEGIN
+  INSERT INTO fts_rewrites(fts_rewrites, rowid, rewrite) VALUES ('delete', OLD.action_id, OLD.rewrite);
+  INSERT INTO fts_rewrites(rowid, rewrite) VALUES (NEW.action_id, NEW.rewrite);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_files_ai AFTER INSERT ON files BEGIN
+  INSERT INTO fts_paths(rowid, path) VALUES (NEW.id, NEW.path);
+END;
+CREATE TRIGGER IF NOT EXISTS trg_files_ad AFTER DELETE ON files BEGIN
+  INSERT INTO fts_paths(fts_paths, rowid, path) VALUES ('delete', OLD.id, OLD.path);
+END;
+CREATE TRIGGER IF NOT EXISTS trg_files_au AFTER UPDATE OF path ON files BEGIN
+  INSERT INTO fts_paths(fts_paths, rowid, path) VALUES ('delete', OLD.id, OLD.path);
+  INSERT INTO fts_paths(rowid, path) VALUES (NEW.id, NEW.path);
+END;
 """
 
 
+def ensure_fts(conn: sqlite3.Connection) -> bool:
+    """Create the FTS5 index and triggers on first use, backfilling existing rows.
+    Returns False (search disabled) if this SQLite build lacks FTS5."""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name='trg_files_au'").fetchone():
+        return True
+    try:
+        conn.executescript(FTS_DDL)
+    except sqlite3.OperationalError as e:
+        logging.warning(f"FTS5 unavailable, search disabled: {e}")
+        return False
+    logging.info("Building full-text index (one time)")
+    with conn:
+        conn.execute("DELETE FROM fts_summaries")
+        conn.execute(
+            f"""
+            INSERT INTO fts_summaries(rowid, path, {", ".join(SUMMARY_FIELDS)})
+            SELECT s.action_id, f.path, {_summary_field_sql("s.summary")}
+            FROM summaries s LEFT JOIN actions a ON a.id = s.action_id LEFT JOIN files f ON f.id = a.file_id
+            """
+        )
+        conn.execute("INSERT INTO fts_rewrites(fts_rewrites) VALUES('rebuild')")
+        conn.execute("INSERT INTO fts_paths(fts_paths) VALUES('rebuild')")
+    return True
+
+
 def db_connect(db_path: str) -> sqlite3.Connection:
     os.makedirs(os.path.dirname(db_path), exist_ok=True)
     conn = sqlite3.connect(db_path)
     conn.execute("PRAGMA foreign_keys=ON")
+    if conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION:
+        return conn
     for stmt in DDL.strip().split(";\n"):
         s = stmt.strip()
         if s:
             conn.execute(s)
+    for table, col, decl in MIGRATIONS:
+        cols = {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+        if col not in cols:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} {decl}")
+    for stmt in MIGRATION_INDEXES:
+        conn.execute(stmt)
+    conn.commit()
+    ensure_fts(conn)
+    conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
     return conn
 
 
+def db_get_state(conn: sqlite3.Connection, key: str, default: str | None = None) -> str | None:
+    row = conn.execute("SELECT value FROM walker_state WHERE key=?", (key,)).fetchone()
+    return row[0] if row else default
+
+
+def db_set_state(conn: sqlite3.Connection, key: str, value: str) -> None:
+    conn.execute(
+        "INSERT INTO walker_state(key,value,updated_at) VALUES(?,?,?) "
+        "ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at",
+        (key, value, human_ts()),
+    )
+    conn.commit()
+
+
 def db_get_or_create_file(conn: sqlite3.Connection, path: str, ext: str, hsh: str) -> int:
     now = human_ts()
     cur = conn.cursor()
@@ -348,40 +650,257 @@ def db_get_pending_queue_paths(conn: sqlite3.Connection) -> list[tuple[str, str]
         return []
 
 
-def db_insert_action(conn: sqlite3.Connection, run_id: int, file_id: int, action: str, model: str, backend: str, prompt: str, file_hash: str, status: str, error: str | None, tokens_in: int | None, tokens_out: int | None) -> int:
+def db_find_content_result(conn: sqlite3.Connection, file_hash: str, action: str, file_id: int) -> int | None:
+    """Return the newest ok action for identical content at another path, if any."""
+    row = conn.execute(
+        "SELECT id FROM actions WHERE file_hash=? AND action=? AND status='ok' AND file_id<>? ORDER BY id DESC LIMIT 1",
+        (file_hash, action, file_id),
+    ).fetchone()
+    return row[0] if row else None
+
+
+def db_insert_action(conn: sqlite3.Connection, run_id: int, file_id: int, action: str, model: str, backend: str, prompt: str, file_hash: str, status: str, error: str | None, tokens_in: int | None, tokens_out: int | None, latency_ms: int | None = None, dedup_of: int | None = None) -> int:
     cur = conn.cursor()
     cur.execute(
         """
-        INSERT INTO actions(run_id,file_id,action,model,backend,prompt,file_hash,tokens_in,tokens_out,status,error,created_at)
-        VALUES(?,?,?,?,?,?,?,?,?,?,?,?)
+        INSERT INTO actions(run_id,file_id,action,model,backend,prompt,file_hash,tokens_in,tokens_out,status,error,created_at,latency_ms,dedup_of)
+        VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)
         """,
-        (run_id, file_id, action, model, backend, prompt, file_hash, tokens_in, tokens_out, status, error or "", human_ts()),
+        (run_id, file_id, action, model, backend, prompt, file_hash, tokens_in, tokens_out, status, error or "", human_ts(), latency_ms, dedup_of),
     )
     conn.commit()
     return cur.lastrowid
 
+def db_store_snapshot(conn: sqlite3.Connection, file_id: int, file_hash: str, action_id: int, data: bytes) -> None:
+    """Keep the content behind a file's latest successful action (base for incremental rewrites)."""
+    conn.execute(
+        "INSERT OR REPLACE INTO file_snapshots(file_id,file_hash,action_id,content,created_at) VALUES(?,?,?,?,?)",
+        (file_id, file_hash, action_id, zlib.compress(data, 6), human_ts()),
+    )
+
+
+def db_load_snapshot(conn: sqlite3.Connection, file_id: int) -> tuple[str, bytes] | None:
+    row = conn.execute("SELECT file_hash, content FROM file_snapshots WHERE file_id=?", (file_id,)).fetchone()
+    if not row:
+        return None
+    try:
+        return row[0], zlib.decompress(row[1])
+    except zlib.error:
+        return None
+
+
+def db_find_origin(conn: sqlite3.Connection, origin: str) -> int | None:
+    """Local id of the action recorded as `origin` ("<host>:<id>"): an imported row with
+    that origin, or a native row (origin NULL) with that id whose run ran on that host."""
+    row = conn.execute("SELECT id FROM actions WHERE origin=?", (origin,)).fetchone()
+    if row:
+        return row[0]
+    host, _, src_id = origin.rpartition(":")
+    if not src_id.isdigit():
+        return None
+    row = conn.execute(
+        "SELECT a.id FROM actions a LEFT JOIN runs r ON r.id = a.run_id "
+        "WHERE a.id=? AND a.origin IS NULL AND COALESCE(r.host, ?)=?",
+        (int(src_id), socket.gethostname(), host),
+    ).fetchone()
+    return row[0] if row else None
+
+
+def db_import_file_id(conn: sqlite3.Connection, rec: dict) -> int:
+    """files.id for an imported action's path, creating a bare row if the export lacked it."""
+    row = conn.execute("SELECT id FROM files WHERE path=?", (rec.get("path"),)).fetchone()
+    if row:
+        return row[0]
+    path = rec.get("path") or ""
+    name = os.path.basename(path)
+    ext = name.split(".")[-1].lower() if "." in name else ""
+    cur = conn.execute(
+        "INSERT INTO files(path,ext,first_seen,last_seen,last_hash) VALUES(?,?,?,?,?)",
+        (path, ext, rec.get("created_at"), rec.get("created_at"), rec.get("file_hash")),
+    )
+    return cur.lastrowid
+
+
 # ---------------------- LLM backends ----------------------
 
 class LLMError(Exception):
     pass
 
 
-def llm_chat(cfg: dict, messages: list[dict], model: str | None = None) -> tuple[str, dict]:
+def db_latency_profile(conn: sqlite3.Connection, window: int = 200) -> dict:
+    """Per backend/model latency stats from the last `window` ok actions.
+    Returns {backend: {model|"*": {"n", "p50_ms_per_tok", "p95_ms_per_tok", "p95_ms", "tok_per_s"}}}."""
+    rows = conn.execute(
+        "SELECT backend, model, latency_ms, tokens_in, tokens_out FROM actions "
+        "WHERE status='ok' AND latency_ms > 0 AND tokens_in > 0 ORDER BY id DESC LIMIT ?",
+        (window * 4,),
+    ).fetchall()
+    groups: dict[tuple[str, str], list[tuple[int, int, int]]] = {}
+    for backend, model, ms, tin, tout in rows:
+        for key in ((backend or "", model or ""), (backend or "", "*")):
+            bucket = groups.setdefault(key, [])
+            if len(bucket) < window:
+                bucket.append((ms, tin, tout or 0))
+    profile: dict = {}
+    for (backend, model), vals in groups.items():
+        per_tok = [ms / tin for ms, tin, _ in vals]
+        total_ms = sum(ms for ms, _, _ in vals)
+        profile.setdefault(backend, {})[model] = {
+            "n": len(vals),
+            "p50_ms_per_tok": percentile(per_tok, 50),
+            "p95_ms_per_tok": percentile(per_tok, 95),
+            "p50_ms": percentile([ms for ms, _, _ in vals], 50),
+            "p95_ms": percentile([ms for ms, _, _ in vals], 95),
+            "tok_per_s": (sum(tin + tout for _, tin, tout in vals) * 1000.0 / total_ms) if total_ms else 0.0,
+        }
+    return profile
+
+
+ROUTE_KEYS = ("model", "backend", "base_url", "num_ctx")
+
+
+def resolve_route(cfg: dict, action: str, ext: str, est_tokens: int) -> dict:
+    """Return cfg with the first matching "routes" rule applied (model/backend/base_url/num_ctx)."""
+    for rule in cfg.get("routes") or []:
+        if not isinstance(rule, dict):
+            continue
+        actions = rule.get("action")
+        if actions and action not in ([actions] if isinstance(actions, str) else actions):
+            continue
+        exts = rule.get("ext")
+        if exts and ext not in ([exts] if isinstance(exts, str) else exts):
+            continue
+        if rule.get("min_tokens") is not None and est_tokens < int(rule["min_tokens"]):
+            continue
+        if rule.get("max_tokens") is not None and est_tokens > int(rule["max_tokens"]):
+            continue
+        routed = dict(cfg)
+        routed.update({k: rule[k] for k in ROUTE_KEYS if rule.get(k) is not None})
+        return routed
+    return cfg
+
+
+def http_policy(cfg: dict) -> dict:
+    policy = dict(CONFIG_TEMPLATE["http"])
+    policy.update(cfg.get("http") or {})
+    return policy
+
+
+def adaptive_timeout(policy: dict, latency: dict | None, backend: str, model: str, est_tokens: int) -> tuple[float, float | None]:
+    """Return (timeout_s, hedge_after_s) for a request of est_tokens input tokens.
+    Without enough history, fall back to the fixed per-backend defaults and no hedging."""
+    default = float(policy["timeout_default_s"].get(backend, 180))
+    stats = (latency or {}).get(backend) or {}
+    st = stats.get(model) or stats.get("*")
+    if not st or st["n"] < int(policy["min_samples"]):
+        return default, None
+    expected_p95 = st["p95_ms_per_tok"] * est_tokens / 1000.0
+    timeout = min(float(policy["timeout_max_s"]), max(float(policy["timeout_min_s"]), expected_p95 * float(policy["timeout_factor"])))
+    hedge_after = max(float(policy["hedge_min_s"]), expected_p95)
+    return timeout, (hedge_after if hedge_after < timeout else None)
+
+
+def post_with_retry(url: str, payload: dict, headers: dict | None, timeout: float, policy: dict):
+    """POST with bounded retries and full-jitter exponential backoff on retryable statuses
+    and connection errors. Timeouts are not retried (the request already used its budget)."""
+    load_requests()
+    retries = max(0, int(policy["retries"]))
+    retry_statuses = set(int(x) for x in policy["retry_statuses"])
+    for attempt in range(retries + 1):
+        try:
+            r = requests.post(url, json=payload, headers=headers, timeout=timeout)
+        except requests.ConnectionError as e:
+            if attempt >= retries:
+                raise
+            wait = random.uniform(0, min(float(policy["backoff_max_s"]), float(policy["backoff_base_s"]) * 2 ** attempt))
+            logging.info(f"Retry {attempt + 1}/{retries} for {url} in {wait:.1f}s: {e}")
+            time.sleep(wait)
+            continue
+        if r.status_code not in retry_statuses or attempt >= retries:
+            return r
+        wait = random.uniform(0, min(float(policy["backoff_max_s"]), float(policy["backoff_base_s"]) * 2 ** attempt))
+        retry_after = r.headers.get("Retry-After", "") if hasattr(r, "headers") else ""
+        if retry_after.isdigit():
+            wait = min(float(policy["backoff_max_s"]), float(retry_after))
+        logging.info(f"Retry {attempt + 1}/{retries} for {url} in {wait:.1f}s: HTTP {r.status_code}")
+        time.sleep(wait)
+    return r
+
+
+def hedged_post(urls: list[str], payload: dict, headers: dict | None, timeout: float, hedge_after: float, policy: dict):
+    """Send to urls[0]; if it has not answered within hedge_after seconds, also send to urls[1]
+    and return whichever successful response arrives first. Losers run on daemon threads
+    so they never hold up process exit."""
+    import queue
+    import threading
+
+    results: queue.Queue = queue.Queue()
+
+    def _worker(u: str):
+        try:
+            results.put((u, post_with_retry(u, payload, headers, timeout, policy), None))
+        except Exception as e:
+            results.put((u, None, e))
+
+    threading.Thread(target=_worker, args=(urls[0],), daemon=True).start()
+    started, pending = 1, 1
+    deadline = time.monotonic() + timeout
+    last_exc: Exception | None = None
+    last_resp = None
+    wait = hedge_after
+    while pending:
+        try:
+            u, resp, exc = results.get(timeout=max(0.0, wait))
+        except queue.Empty:
+            if started < len(urls):
+                logging.info(f"Hedging after {hedge_after:.1f}s: {urls[started]}")
+                threading.Thread(target=_worker, args=(urls[started],), daemon=True).start()
+                started += 1
+                pending += 1
+                wait = deadline - time.monotonic()
+                continue
+            raise LLMError(f"Timed out after {timeout:.0f}s (hedged)")
+        pending -= 1
+        if resp is not None and resp.status_code < 400:
+            return resp
+        last_exc, last_resp = exc, resp
+        if started < len(urls) and pending == 0:
+            # Primary failed fast: go to the hedge endpoint right away
+            threading.Thread(target=_worker, args=(urls[started],), daemon=True).start()
+            started += 1
+            pending += 1
+        wait = deadline - time.monotonic()
+    if last_resp is not None:
+        return last_resp
+    raise last_exc or LLMError("hedged request failed")
+
+
+def llm_chat(cfg: dict, messages: list[dict], model: str | None = None, latency: dict | None = None) -> tuple[str, dict]:
     """Try backends based on cfg['backend'] with graceful fallback.
     Returns (text, meta) where meta can include usage/token counts.
+    `latency` (see db_latency_profile) enables adaptive timeouts and hedging.
     """
     backend_pref = (cfg.get("backend") or "auto").lower()
     tried = []
     model = model or cfg.get("model") or "gemma3:4b"
+    policy = http_policy(cfg)
+    est_tokens = estimate_tokens("".join(str(m.get("content") or "") for m in messages))
+
+    def _post(backend: str, base: str, path: str, payload: dict, headers: dict | None = None, mdl: str | None = None):
+        timeout, hedge_after = adaptive_timeout(policy, latency, backend, mdl or model, est_tokens)
+        hedge_base = (policy.get("hedge_base_url") or "").rstrip("/")
+        if hedge_base and hedge_after is not None and hedge_base != base.rstrip("/"):
+            return hedged_post([base + path, hedge_base + path], payload, headers, timeout, hedge_after, policy)
+        return post_with_retry(base + path, payload, headers, timeout, policy)
 
     def _try_lmstudio():
-        url = (cfg.get("base_url") or os.getenv("LLM_BASE_URL") or "") + "/v1/chat/completions"        
-        print(f"LM Studio URL: {url} (model: {model})")
+        base = cfg.get("base_url") or os.getenv("LLM_BASE_URL") or ""
+        print(f"LM Studio URL: {base}/v1/chat/completions (model: {model})")
         payload = {"model": model, "messages": messages, "temperature": 0.2}
         headers = {"Content-Type": "application/json"}
         if cfg.get("api_key") or os.getenv("LLM_API_KEY"):
             headers["Authorization"] = f"Bearer {cfg.get('api_key') or os.getenv('LLM_API_KEY')}"
-        r = requests.post(url, json=payload, headers=headers, timeout=900)
+        r = _post("lmstudio", base, "/v1/chat/completions", payload, headers)
         if r.status_code >= 400:
             raise LLMError(f"LM Studio {r.status_code}: {r.text[:200]}")
         j = r.json()
@@ -389,12 +908,15 @@ def llm_chat(cfg: dict, messages: list[dict], model: str | None = None) -> tuple
         return text, {"backend": "lmstudio", "raw": j, "usage": j.get("usage")}
 
     def _try_ollama():
-        url = (cfg.get("base_url") or "") + "/api/chat"
-        print(f"Ollama URL: {url}")
-        # Ollama uses gemma3:4b
-        model = "gemma3:4b"
-        payload = {"model": model, "messages": messages, "options": {"temperature": 0.2}}
-        r = requests.post(url, json=payload, timeout=180)
+        base = cfg.get("base_url") or ""
+        # An explicit ollama backend (config or route) gets the requested model; "auto" fallback uses ollama_model
+        model_ = model if backend_pref == "ollama" else (cfg.get("ollama_model") or "gemma3:4b")
+        print(f"Ollama URL: {base}/api/chat (model: {model_})")
+        options = {"temperature": 0.2}
+        if cfg.get("num_ctx"):
+            options["num_ctx"] = int(cfg["num_ctx"])
+        payload = {"model": model_, "messages": messages, "options": options, "stream": False}
+        r = _post("ollama", base, "/api/chat", payload, mdl=model_)
         if r.status_code >= 400:
             raise LLMError(f"Ollama {r.status_code}: {r.text[:200]}")
         # Ollama may stream by default; ensure we get full JSON by using non-stream endpoint
@@ -407,18 +929,18 @@ def llm_chat(cfg: dict, messages: list[dict], model: str | None = None) -> tuple
                 text = msgs[-1].get("content", "")
         if not text:
             raise LLMError("Ollama: empty content")
-        return text, {"backend": "ollama", "raw": j}
+        usage = {"prompt_tokens": j.get("prompt_eval_count"), "completion_tokens": j.get("eval_count")}
+        return text, {"backend": "ollama", "model": model_, "raw": j, "usage": usage}
 
     def _try_openai_compat():
         base = cfg.get("base_url") or os.getenv("LLM_BASE_URL")
         if not base:
             raise LLMError("openai_compat requires base_url (LLM_BASE_URL)")
-        url = base.rstrip("/") + "/v1/chat/completions"
         payload = {"model": model, "messages": messages, "temperature": 0.2}
         headers = {"Content-Type": "application/json"}
         if cfg.get("api_key") or os.getenv("LLM_API_KEY"):
             headers["Authorization"] = f"Bearer {cfg.get('api_key') or os.getenv('LLM_API_KEY')}"
-        r = requests.post(url, json=payload, headers=headers, timeout=180)
+        r = _post("openai_compat", base.rstrip("/"), "/v1/chat/completions", payload, headers)
         if r.status_code >= 400:
             raise LLMError(f"OpenAI‑compat {r.status_code}: {r.text[:200]}")
         j = r.json()
@@ -450,6 +972,218 @@ def llm_chat(cfg: dict, messages: list[dict], model: str | None = None) -> tuple
             continue
     raise LLMError(f"All backends failed (tried: {tried}): {last_exc}")
 
+# ---------------------- Embeddings ----------------------
+
+def llm_embed(cfg: dict, text: str) -> list[float]:
+    """Return an embedding vector for `text` from the configured local backend."""
+    ecfg = cfg.get("embeddings") or {}
+    backend_pref = (ecfg.get("backend") or cfg.get("backend") or "auto").lower()
+    model = ecfg.get("model") or cfg.get("model")
+    base = (ecfg.get("base_url") or cfg.get("base_url") or os.getenv("LLM_BASE_URL") or "").rstrip("/")
+
+    def _try_openai_compat():
+        # LM Studio and other OpenAI-compatible servers
+        headers = {"Content-Type": "application/json"}
+        if cfg.get("api_key") or os.getenv("LLM_API_KEY"):
+            headers["Authorization"] = f"Bearer {cfg.get('api_key') or os.getenv('LLM_API_KEY')}"
+        r = post_with_retry(base + "/v1/embeddings", {"model": model, "input": text}, headers, 120, http_policy(cfg))
+        if r.status_code >= 400:
+            raise LLMError(f"Embeddings {r.status_code}: {r.text[:200]}")
+        return r.json()["data"][0]["embedding"]
+
+    def _try_ollama():
+        r = post_with_retry(base + "/api/embeddings", {"model": model, "prompt": text}, None, 120, http_policy(cfg))
+        if r.status_code >= 400:
+            raise LLMError(f"Ollama embeddings {r.status_code}: {r.text[:200]}")
+        vec = r.json().get("embedding")
+        if not vec:
+            raise LLMError("Ollama: empty embedding")
+        return vec
+
+    if backend_pref == "ollama":
+        sequence = [_try_ollama]
+    elif backend_pref in ("lmstudio", "openai", "openai_compat", "custom"):
+        sequence = [_try_openai_compat]
+    else:
+        sequence = [_try_openai_compat, _try_ollama]
+
+    last_exc = None
+    for fn in sequence:
+        try:
+            return [float(x) for x in fn()]
+        except Exception as e:
+            last_exc = e
+    raise LLMError(f"Embedding failed: {last_exc}")
+
+
+def embeddings_path(cfg: dict) -> str:
+    ecfg = cfg.get("embeddings") or {}
+    return ecfg.get("path") or os.path.splitext(cfg["db_path"])[0] + ".vec"
+
+
+def summary_embed_text(path: str, summary: str) -> str:
+    """Flatten a summary JSON into plain text for embedding."""
+    try:
+        data = json.loads(summary)
+    except Exception:
+        data = {"raw": summary}
+    parts = [f"File: {path}"]
+    if isinstance(data, dict):
+        for k in SUMMARY_FIELDS:
+            v = data.get(k)
+            if v:
+                parts.append(f"{k}: {v if isinstance(v, str) else json.dumps(v, ensure_ascii=False)}")
+    else:
+        parts.append(str(data))
+    return "\n".join(parts)
+
+
+def store_embedding(conn: sqlite3.Connection, cfg: dict, action_id: int, vec: list[float]) -> None:
+    """Append a unit-normalized float32 vector to the .vec file and map its slot to action_id."""
+    if load_numpy() is None:
+        raise RuntimeError("numpy is required for embeddings (pip install numpy)")
+    arr = np.asarray(vec, dtype=np.float32)
+    norm = float(np.linalg.norm(arr))
+    if norm > 0:
+        arr /= norm
+    row = conn.execute("SELECT dim FROM embeddings LIMIT 1").fetchone()
+    if row and int(row[0]) != arr.size:
+        raise RuntimeError(f"Embedding dim {arr.size} != index dim {row[0]}; remove {embeddings_path(cfg)} and the embeddings table to rebuild")
+    path = embeddings_path(cfg)
+    with open(path, "ab") as fh:
+        # Slot derived from file size so a crash before the INSERT only leaves an unmapped row
+        slot = fh.tell() // (4 * arr.size)
+        fh.write(arr.tobytes())
+    conn.execute(
+        "INSERT OR REPLACE INTO embeddings(action_id,slot,dim,model,created_at) VALUES(?,?,?,?,?)",
+        (action_id, slot, arr.size, (cfg.get("embeddings") or {}).get("model") or cfg.get("model"), human_ts()),
+    )
+
+
+def compact_embeddings(conn: sqlite3.Connection, cfg: dict) -> int:
+    """Rewrite the .vec file without rows no embeddings entry points at (pruned or
+    re-embedded actions) once they exceed embeddings.compact_dead_ratio. Returns the
+    number of rows dropped. Live rows are copied in slot order to a temp file, then the
+    new slots and the file swap are committed together; the walker lock is expected
+    to be held (see --maintain), and a concurrent --embed append aborts the pass."""
+    path = embeddings_path(cfg)
+    row = conn.execute("SELECT dim, COUNT(*) FROM embeddings").fetchone()
+    if not row[1] or not os.path.isfile(path):
+        return 0
+    ratio = (cfg.get("embeddings") or {}).get("compact_dead_ratio", CONFIG_TEMPLATE["embeddings"]["compact_dead_ratio"])
+    row_bytes = 4 * int(row[0])
+    size = os.path.getsize(path)
+    total = size // row_bytes
+    dead = total - int(row[1])
+    if dead <= 0 or dead < float(ratio) * total:
+        return 0
+    tmp = path + ".compact"
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        moves = []
+        with open(path, "rb") as src, open(tmp, "wb") as dst:
+            for action_id, slot in conn.execute("SELECT action_id, slot FROM embeddings ORDER BY slot"):
+                if slot >= total:
+                    continue  # never written (crash between append and INSERT)
+                src.seek(slot * row_bytes)
+                dst.write(src.read(row_bytes))
+                moves.append((len(moves), action_id))
+            dst.flush()
+            os.fsync(dst.fileno())
+        if os.path.getsize(path) != size:
+            raise RuntimeError("vector file grew during compaction")
+        conn.executemany("UPDATE embeddings SET slot=? WHERE action_id=?", moves)
+        conn.execute("DELETE FROM embeddings WHERE slot >= ?", (total,))
+        os.replace(tmp, path)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        logging.warning(f"Vector file compaction skipped: {e}")
+        return 0
+    logging.info(f"Compacted {path}: dropped {total - len(moves)} unused of {total} vectors")
+    return total - len(moves)
+
+
+def embed_summary(conn: sqlite3.Connection, cfg: dict, action_id: int, path: str, summary: str) -> bool:
+    """Optional pipeline stage: embed one summary. Failures are logged, never fatal."""
+    try:
+        store_embedding(conn, cfg, action_id, llm_embed(cfg, summary_embed_text(path, summary)))
+        conn.commit()
+        return True
+    except Exception as e:
+        logging.warning(f"Embedding failed for action {action_id}: {e}")
+        return False
+
+
+def embed_backfill(cfg: dict, limit: int) -> int:
+    """Embed up to `limit` summaries that have no vector yet (newest first)."""
+    conn = db_connect(cfg["db_path"])
+    done = 0
+    try:
+        rows = conn.execute(
+            """
+            SELECT s.action_id, f.path, s.summary FROM summaries s
+            JOIN actions a ON a.id = s.action_id JOIN files f ON f.id = a.file_id
+            LEFT JOIN embeddings e ON e.action_id = s.action_id
+            WHERE e.action_id IS NULL ORDER BY s.action_id DESC LIMIT ?
+            """,
+            (limit,),
+        ).fetchall()
+        for action_id, path, summary in rows:
+            if embed_summary(conn, cfg, action_id, path, summary):
+                done += 1
+    finally:
+        conn.close()
+    logging.info(f"Embedded {done}/{len(rows)} summaries")
+    return done
+
+
+def similar_search(cfg: dict, path: str | None = None, text: str | None = None, top: int = 20) -> list[tuple[float, str, int]]:
+    """Top-k cosine search over summary embeddings. Query by an indexed file path
+    or by free text (embedded on the fly). Returns [(score, path, action_id)], best per file."""
+    if load_numpy() is None:
+        raise RuntimeError("numpy is required for similarity search (pip install numpy)")
+    conn = db_connect(cfg["db_path"])
+    try:
+        rows = conn.execute(
+            "SELECT e.slot, e.action_id, e.dim, f.path FROM embeddings e "
+            "JOIN actions a ON a.id = e.action_id JOIN files f ON f.id = a.file_id"
+        ).fetchall()
+        if not rows:
+            return []
+        dim = int(rows[0][2])
+        mat = np.memmap(embeddings_path(cfg), dtype=np.float32, mode="r")
+        mat = mat[: (mat.size // dim) * dim].reshape(-1, dim)
+        slots = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+        if path is not None:
+            mine = [r for r in rows if r[3] == path or r[3] == os.path.abspath(path)]
+            if not mine:
+                raise RuntimeError(f"No embedding for {path}; run --embed first")
+            q = np.asarray(mat[max(mine, key=lambda r: r[1])[0]], dtype=np.float32)
+        else:
+            q = np.asarray(llm_embed(cfg, text or ""), dtype=np.float32)
+            q /= float(np.linalg.norm(q)) or 1.0
+        scores = mat[slots] @ q
+        # Over-fetch so per-file dedup still yields `top` distinct paths
+        k = min(len(rows), max(top * 4, top + 1))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        out: list[tuple[float, str, int]] = []
+        seen = {path, os.path.abspath(path)} if path else set()
+        for i in best:
+            _, action_id, _, p = rows[int(i)]
+            if p in seen:
+                continue
+            seen.add(p)
+            out.append((float(scores[i]), p, action_id))
+            if len(out) >= top:
+                break
+        return out
+    finally:
+        conn.close()
+
 # ---------------------- Walker ----------------------
 
 CODE_LIKE_EXT = {"php", "py", "sh"}
@@ -486,58 +1220,146 @@ def should_skip_file(rel_file: str, name: str, exclude_files: list[str]) -> bool
     return False
 
 
-def gather_candidates(cfg: dict) -> list[str]:
-    base = Path(cfg["scan_path"]).resolve()
-    ex = cfg.get("exclude_dirs") or []    
+# Candidate discovery is a lazy pipeline: walk/filter/stat (scan_tree) -> select.
+# A run that needs two files never materializes more than the walker's frontier.
+
+def load_gitignore_patterns(base: Path) -> set[str]:
+    patterns: set[str] = set()
+    gi_path = base / ".gitignore"
+    if gi_path.exists():
+        try:
+            for line in gi_path.read_text(encoding="utf-8", errors="ignore").splitlines():
+                s = line.strip()
+                if not s or s.startswith("#"):
+                    continue
+                patterns.add(s)
+        except Exception:
+            pass
+    return patterns
+
+
+def scan_tree(cfg: dict) -> Iterator[tuple[str, str, int, float]]:
+    """Yield (full_path, ext, size, mtime) for every candidate under scan_path.
+
+    Directory listings use os.scandir and fan out over a bounded thread pool
+    (walk_threads), which hides per-directory round trips on NFS/SSHFS. Listings are
+    prefetched only for the next walk_threads directories in walk order, so a consumer
+    that stops early leaves the rest of the tree unlisted. Filtering
+    happens on DirEntry names before any stat, so only wanted files are stat'ed.
+    Results come out in sorted pre-order regardless of thread timing. Symlinked
+    directories are not followed (like os.walk(followlinks=False)).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    base = str(Path(cfg["scan_path"]).resolve())
+    ex = cfg.get("exclude_dirs") or []
     ex = [e.strip("/") for e in ex]
     ex = list(dict.fromkeys(ex))  # dedupe
     ex_files = cfg.get("exclude_files") or []
-
     file_types = set([e.lstrip(".").lower() for e in cfg.get("file_types", [])])
     max_bytes = int(cfg.get("max_filesize_kb", 512)) * 1024
-    respect_gitignore = bool(cfg.get("respect_gitignore", True))
-    git_ignores: set[str] = set()
+    git_ignores = load_gitignore_patterns(Path(base)) if bool(cfg.get("respect_gitignore", True)) else set()
+    threads = max(1, int(cfg.get("walk_threads") or 8))
 
-    if respect_gitignore:
-        gi_path = base / ".gitignore"
-        if gi_path.exists():
+    def _list(path: str, rel: str):
+        files: list[tuple[str, str, int, float]] = []
+        children: list[tuple[str, str]] = []
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            return files, []
+        for entry in entries:
             try:
-                for line in gi_path.read_text(encoding="utf-8", errors="ignore").splitlines():
-                    s = line.strip()
-                    if not s or s.startswith("#"):
+                if entry.is_dir():
+                    if entry.is_symlink():
                         continue
-                    git_ignores.add(s)
-            except Exception:
-                pass
-
-    candidates: list[str] = []
-    for root, dirs, files in os.walk(base, followlinks=False):
-        rel = os.path.relpath(root, base)
-        if rel == ".":
-            rel = ""
-        if should_skip_dir(rel, ex):
-            # Prune traversal
-            dirs[:] = []
-            continue
-        # prune by .gitignore patterns (basic)
-        if respect_gitignore and git_ignores:
-            dirs[:] = [d for d in dirs if not any(fnmatch.fnmatch(d, pat) for pat in git_ignores)]
-        for fn in files:
-            ext = fn.split(".")[-1].lower() if "." in fn else ""
+                    child_rel = os.path.join(rel, entry.name) if rel else entry.name
+                    # Prune traversal by exclude_dirs and .gitignore patterns (basic)
+                    if should_skip_dir(child_rel, ex):
+                        continue
+                    if git_ignores and any(fnmatch.fnmatch(entry.name, pat) for pat in git_ignores):
+                        continue
+                    children.append((entry.path, child_rel))
+                    continue
+                if not entry.is_file():
+                    continue
+            except OSError:
+                continue
+            name = entry.name
+            ext = name.split(".")[-1].lower() if "." in name else ""
             if ext not in file_types:
                 continue
-            full = str(Path(root) / fn)
-            # Skip files by name/path patterns
-            rel_file = os.path.relpath(full, base)
-            if should_skip_file(rel_file, fn, ex_files):
+            if should_skip_file(os.path.join(rel, name) if rel else name, name, ex_files):
                 continue
             try:
-                if os.path.getsize(full) > max_bytes and ext in CODE_LIKE_EXT:
-                    # too big for code; skip (logs handled later)
-                    continue
+                st = entry.stat()
             except OSError:
                 continue
-            candidates.append(full)
+            if st.st_size > max_bytes and ext in CODE_LIKE_EXT:
+                # too big for code; skip (logs handled later)
+                continue
+            files.append((entry.path, ext, st.st_size, st.st_mtime))
+        return files, children
+
+    pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="cw-walk")
+    try:
+        # Stack of [path, rel, future-or-None]; the top is the next directory in pre-order.
+        # Only the next `threads` directories are submitted, so the walk stays just ahead
+        # of the consumer instead of listing the whole tree into finished futures.
+        stack = [[base, "", None]]
+        while stack:
+            for item in stack[-threads:]:
+                if item[2] is None:
+                    item[2] = pool.submit(_list, item[0], item[1])
+            files, children = stack.pop()[2].result()
+            yield from files
+            stack.extend([c_path, c_rel, None] for c_path, c_rel in reversed(children))
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_candidates(cfg: dict) -> Iterator[tuple[str, str, int, float]]:
+    return scan_tree(cfg)
+
+
+SAMPLE_WEIGHTS = {
+    "uniform": lambda size, mtime: 1.0,
+    # Prefer recently modified files (weight halves every 7 days of age)
+    "recent": lambda size, mtime: 0.5 ** (max(0.0, time.time() - mtime) / (7 * 86400)),
+    # Prefer small files (cheap to process)
+    "small": lambda size, mtime: 1.0 / (1.0 + size / 1024.0),
+}
+
+
+def reservoir_sample(items: Iterable[tuple[str, str, int, float]], k: int, weight=None, rng: random.Random | None = None) -> list[str]:
+    """Pick k paths from a stream in one pass and O(k) memory.
+
+    Weighted reservoir sampling (Efraimidis–Spirakis A-Res): each item gets key
+    u ** (1 / w) and the k largest keys win; with w == 1 this is a uniform sample.
+    Returned in random order.
+    """
+    rng = rng or random
+    heap: list[tuple[float, str]] = []
+    if k <= 0:
+        return []
+    for path, _ext, size, mtime in items:
+        w = weight(size, mtime) if weight else 1.0
+        if w <= 0:
+            continue
+        key = rng.random() ** (1.0 / w)
+        if len(heap) < k:
+            heapq.heappush(heap, (key, path))
+        elif key > heap[0][0]:
+            heapq.heapreplace(heap, (key, path))
+    sample = [p for _, p in heap]
+    rng.shuffle(sample)
+    return sample
+
+
+def gather_candidates(cfg: dict) -> list[str]:
+    """Full shuffled candidate list (used where the whole tree is needed, e.g. --plan)."""
+    candidates = [c[0] for c in iter_candidates(cfg)]
     random.shuffle(candidates)
     return candidates
 
@@ -588,15 +1410,558 @@ def extract_first_codeblock(text: str) -> tuple[str, str] | None:
     return lang, body
 
 
+# ---------------------- Incremental rewrites ----------------------
+
+REGION_INSTR_PREFIX = (
+    "You are CodeWalker, a careful refactoring assistant. You are given only the regions of a file that changed "
+    "since it was last reviewed. Rewrite each REGION for clarity and modularity while preserving behavior and "
+    "anything other code relies on (names, signatures, indentation level). Lines marked as context are read-only. "
+    "Output one fenced code block per region, in order, whose info string is its label (```region-1), containing "
+    "only that region's replacement."
+)
+
+PHP_BLOCK_RE = re.compile(r"^\s*(?:(?:abstract|final|public|protected|private|static)\s+)*(?:function\s+&?\w+\s*\(|(?:class|interface|trait)\s+\w+)", re.I)
+SH_BLOCK_RE = re.compile(r"^\s*(?:function\s+[\w:.-]+(?:\s*\(\s*\))?|[\w:.-]+\s*\(\s*\))\s*\{?\s*(?:#.*)?$")
+
+
+def _brace_block_end(lines: list[str], start: int) -> int | None:
+    """Index just past the line that closes the first `{` at or after `start`.
+    Skips quoted strings and // or # comments; good enough for PHP and shell."""
+    depth = 0
+    opened = False
+    for i in range(start, len(lines)):
+        line = lines[i]
+        quote = None
+        j = 0
+        while j < len(line):
+            ch = line[j]
+            if quote:
+                if ch == "\\":
+                    j += 1
+                elif ch == quote:
+                    quote = None
+            elif ch in ("'", '"'):
+                quote = ch
+            elif (ch == "#" and (j == 0 or line[j - 1].isspace())) or line.startswith("//", j):
+                break
+            elif ch == "{":
+                depth += 1
+                opened = True
+            elif ch == "}":
+                depth -= 1
+                if opened and depth == 0:
+                    return i + 1
+            j += 1
+        if not opened and i > start + 2:
+            return None  # declaration without a body (abstract/interface method)
+    return None
+
+
+def block_ranges(lines: list[str], ext: str) -> list[tuple[int, int]]:
+    """Function/class blocks as (start, end) line ranges (0-based, end exclusive),
+    nested ones included. Python uses ast; PHP and shell a brace-matching splitter."""
+    ranges: list[tuple[int, int]] = []
+    if ext == "py":
+        try:
+            tree = ast.parse("\n".join(lines))
+        except (SyntaxError, ValueError):
+            return []
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                start = min([node.lineno] + [d.lineno for d in node.decorator_list]) - 1
+                ranges.append((start, node.end_lineno or node.lineno))
+        return ranges
+    pattern = PHP_BLOCK_RE if ext == "php" else SH_BLOCK_RE
+    for i, line in enumerate(lines):
+        if pattern.match(line):
+            end = _brace_block_end(lines, i)
+            if end:
+                ranges.append((i, end))
+    return ranges
+
+
+def changed_regions(old_text: str, new_text: str, ext: str) -> list[tuple[int, int]]:
+    """Line ranges of new_text to rewrite: every changed line, widened to the smallest
+    enclosing function/class, overlapping ranges merged. Pure deletions outside a
+    block need nothing rewritten."""
+    old_lines = old_text.split("\n")
+    new_lines = new_text.split("\n")
+    blocks = block_ranges(new_lines, ext)
+    spans: list[tuple[int, int]] = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, _i1, _i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        lo, hi = j1, max(j2, j1 + 1)
+        enclosing = [b for b in blocks if b[0] <= lo and hi <= b[1]]
+        if enclosing:
+            spans.append(min(enclosing, key=lambda b: b[1] - b[0]))
+        elif j2 > j1:
+            spans.append((j1, j2))
+    merged: list[tuple[int, int]] = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def region_prompt(lines: list[str], regions: list[tuple[int, int]], ext: str, context: int) -> str:
+    parts = []
+    for n, (start, end) in enumerate(regions, 1):
+        before = lines[max(0, start - context):start]
+        after = lines[end:end + context]
+        body = "\n".join(lines[start:end]).replace("```", "``\\`")
+        part = f"REGION region-{n} (lines {start + 1}-{end}):\n"
+        if before:
+            part += "Context before (read-only):\n" + "\n".join(before) + "\n"
+        part += f"```{ext}\n{body}\n```\n"
+        if after:
+            part += "Context after (read-only):\n" + "\n".join(after) + "\n"
+        parts.append(part)
+    return "\n".join(parts)
+
+
+def splice_regions(lines: list[str], regions: list[tuple[int, int]], reply: str) -> tuple[str, int]:
+    """Replace each region with its `region-N` block from the reply; regions the
+    reply leaves out stay as they are. Returns (full text, regions replaced)."""
+    blocks = {m.group(1): m.group(2) for m in CODE_BLOCK_RE.finditer(reply)}
+    out: list[str] = []
+    prev = 0
+    replaced = 0
+    for n, (start, end) in enumerate(regions, 1):
+        out.extend(lines[prev:start])
+        body = blocks.get(f"region-{n}")
+        if body is None:
+            out.extend(lines[start:end])
+        else:
+            out.extend(body[:-1].split("\n") if body.endswith("\n") else body.split("\n"))
+            replaced += 1
+        prev = end
+    out.extend(lines[prev:])
+    return "\n".join(out), replaced
+
+
+def plan_incremental(cfg: dict, conn: sqlite3.Connection, file_id: int, hsh: str, text: str, ext: str) -> list[tuple[int, int]] | None:
+    """Regions to rewrite for an incremental rewrite, or None for a full rewrite
+    (disabled, no earlier version, unchanged, or too much changed)."""
+    icfg = cfg.get("incremental_rewrite") or {}
+    if not icfg.get("enabled") or ext not in CODE_LIKE_EXT:
+        return None
+    snapshot = db_load_snapshot(conn, file_id)
+    if not snapshot or snapshot[0] == hsh:
+        return None
+    regions = changed_regions(snapshot[1].decode("utf-8", errors="ignore"), text, ext)
+    total = max(1, len(text.split("\n")))
+    changed = sum(end - start for start, end in regions)
+    if not regions or len(regions) > int(icfg.get("max_regions") or 12):
+        return None
+    if changed / total > float(icfg.get("max_changed_ratio") or 0.6):
+        return None
+    return regions
+
+
 # ---------------------- External Prompt Loading ----------------------
 
 ## Legacy load_external_prompts removed in favor of simple load_prompt_list.
 
 
+# ---------------------- Maintenance ----------------------
+
+ROLLUP_SQL = """
+INSERT INTO daily_rollup(day,model,backend,action,actions,errors,tokens_in,tokens_out,latency_ms_sum,latency_n)
+SELECT substr(created_at,1,10), COALESCE(model,''), COALESCE(backend,''), COALESCE(action,''),
+       COUNT(*), SUM(CASE WHEN status='error' THEN 1 ELSE 0 END),
+       COALESCE(SUM(tokens_in),0), COALESCE(SUM(tokens_out),0),
+       -- dedup rows made no model call (older ones were stored with latency_ms=0)
+       COALESCE(SUM(CASE WHEN status<>'dedup' THEN latency_ms END),0),
+       COUNT(CASE WHEN status<>'dedup' THEN latency_ms END)
+FROM actions WHERE id IN (SELECT id FROM temp.prune_batch)
+GROUP BY 1,2,3,4
+ON CONFLICT(day,model,backend,action) DO UPDATE SET
+  actions=actions+excluded.actions,
+  errors=errors+excluded.errors,
+  tokens_in=tokens_in+excluded.tokens_in,
+  tokens_out=tokens_out+excluded.tokens_out,
+  latency_ms_sum=latency_ms_sum+excluded.latency_ms_sum,
+  latency_n=latency_n+excluded.latency_n
+"""
+
+
+def maintain_db(cfg: dict) -> dict:
+    """Apply retention, roll pruned actions into daily_rollup, then vacuum/analyze in bounded steps.
+
+    Pruned actions are always aggregated first, so daily_rollup + actions together
+    still give complete per-day totals. Work stops at retention.time_budget_s; the
+    next call continues where this one left off.
+    """
+    ret = dict(CONFIG_TEMPLATE["retention"])
+    ret.update(cfg.get("retention") or {})
+    keep = max(1, int(ret.get("keep_actions_per_file") or 1))
+    cutoff = human_ts(time.time() - float(ret.get("min_age_days") or 0) * 86400)
+    batch_size = max(1, int(ret.get("batch_size") or 2000))
+    vacuum_pages = max(1, int(ret.get("vacuum_pages") or 1000))
+    deadline = time.monotonic() + float(ret.get("time_budget_s") or 30)
+    stats = {"pruned_actions": 0, "pruned_runs": 0, "compacted_vectors": 0, "vacuumed_pages": 0, "complete": True}
+
+    conn = db_connect(cfg["db_path"])
+    try:
+        keep_filter = "AND id NOT IN (SELECT action_id FROM applied_rewrites)" if ret.get("keep_applied", True) else ""
+        # Results that dedup rows link to must outlive their own file's retention window
+        keep_filter += " AND id NOT IN (SELECT dedup_of FROM actions WHERE dedup_of IS NOT NULL)"
+        conn.execute("DROP TABLE IF EXISTS temp.prune_ids")
+        conn.execute(
+            f"""
+            CREATE TEMP TABLE prune_ids AS
+            SELECT id FROM (
+              SELECT id, created_at, ROW_NUMBER() OVER (PARTITION BY file_id ORDER BY id DESC) AS rn
+              FROM actions
+            )
+            WHERE rn > ? AND created_at < ? {keep_filter}
+            ORDER BY id
+            """,
+            (keep, cutoff),
+        )
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS prune_batch (id INTEGER PRIMARY KEY)")
+        conn.commit()
+
+        while True:
+            if time.monotonic() > deadline:
+                stats["complete"] = False
+                break
+            ids = [r[0] for r in conn.execute("SELECT id FROM temp.prune_ids ORDER BY id LIMIT ?", (batch_size,))]
+            if not ids:
+                break
+            with conn:
+                conn.execute("DELETE FROM temp.prune_batch")
+                conn.executemany("INSERT INTO temp.prune_batch(id) VALUES(?)", ((i,) for i in ids))
+                conn.execute(ROLLUP_SQL)
+                conn.execute("DELETE FROM summaries WHERE action_id IN (SELECT id FROM temp.prune_batch)")
+                conn.execute("DELETE FROM embeddings WHERE action_id IN (SELECT id FROM temp.prune_batch)")
+                conn.execute("DELETE FROM rewrites WHERE action_id IN (SELECT id FROM temp.prune_batch)")
+                conn.execute("DELETE FROM actions WHERE id IN (SELECT id FROM temp.prune_batch)")
+                conn.execute("DELETE FROM temp.prune_ids WHERE id IN (SELECT id FROM temp.prune_batch)")
+            stats["pruned_actions"] += len(ids)
+
+        # Runs that no longer own any action carry only their config snapshot
+        cur = conn.execute(
+            "DELETE FROM runs WHERE finished_at IS NOT NULL AND started_at < ? "
+            "AND NOT EXISTS (SELECT 1 FROM actions a WHERE a.run_id = runs.id)",
+            (cutoff,),
+        )
+        stats["pruned_runs"] = cur.rowcount
+        conn.commit()
+
+        # Pruned embeddings rows leave their vectors behind in the .vec file
+        if time.monotonic() < deadline:
+            stats["compacted_vectors"] = compact_embeddings(conn, cfg)
+        else:
+            stats["complete"] = False
+
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            if ret.get("convert_auto_vacuum") and time.monotonic() > deadline:
+                stats["complete"] = False  # convert on a run that has budget left
+            elif ret.get("convert_auto_vacuum"):
+                # One-time conversion of a DB created before auto_vacuum=INCREMENTAL
+                logging.info("Converting DB to auto_vacuum=INCREMENTAL (full VACUUM, one time)")
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+            else:
+                logging.info(
+                    "Incremental vacuum unavailable (DB predates auto_vacuum=INCREMENTAL); skipping. "
+                    "Set retention.convert_auto_vacuum to convert it with one full VACUUM."
+                )
+        else:
+            while time.monotonic() < deadline:
+                free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if not free:
+                    break
+                step = min(free, vacuum_pages)
+                conn.execute(f"PRAGMA incremental_vacuum({step})").fetchall()
+                stats["vacuumed_pages"] += step
+            else:
+                stats["complete"] = False
+
+        # Bounded ANALYZE: sample at most analysis_limit rows per index
+        conn.execute("PRAGMA analysis_limit=1000")
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA optimize")
+        conn.commit()
+    finally:
+        conn.close()
+
+    logging.info(
+        "Maintenance: pruned %d actions, %d runs; dropped %d unused vectors; vacuumed %d pages%s",
+        stats["pruned_actions"], stats["pruned_runs"], stats["compacted_vectors"], stats["vacuumed_pages"],
+        "" if stats["complete"] else " (time budget reached; rerun to continue)",
+    )
+    return stats
+
+
+# ---------------------- Search ----------------------
+
+def fts_literal(query: str) -> str:
+    """Quote each whitespace-separated term as an FTS5 string ('copy.py' -> '"copy.py"')."""
+    return " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+
+
+def search_index(cfg: dict, query: str, top: int = 20) -> list[dict]:
+    """Ranked full-text search over summaries, rewrites and paths.
+    `query` is FTS5 syntax, e.g. 'curl', '"sql injection"', 'risks: eval'. Queries
+    that are not valid FTS5 (filenames like 'copy.py', 'tree/b', 'push -f') are
+    retried with every term quoted.
+
+    BM25 scores are only comparable within one index (they depend on its size and
+    document lengths), so each source is ranked on its own and the lists are
+    interleaved by rank: every source's best hit, then every second best, and so on.
+    `score` is the hit's BM25 within its own source; `rank` is its position there."""
+    conn = db_connect(cfg["db_path"])
+    try:
+        if not ensure_fts(conn):
+            return []
+        sources = [
+            ("summary", f"""
+                SELECT s.rowid, s.path, bm25(fts_summaries),
+                       snippet(fts_summaries, -1, '[', ']', '…', 16)
+                FROM fts_summaries s WHERE fts_summaries MATCH ?
+                ORDER BY bm25(fts_summaries) LIMIT ?"""),
+            ("rewrite", """
+                SELECT r.rowid, f.path, bm25(fts_rewrites),
+                       snippet(fts_rewrites, 0, '[', ']', '…', 16)
+                FROM fts_rewrites r
+                LEFT JOIN actions a ON a.id = r.rowid LEFT JOIN files f ON f.id = a.file_id
+                WHERE fts_rewrites MATCH ?
+                ORDER BY bm25(fts_rewrites) LIMIT ?"""),
+            ("path", """
+                SELECT p.rowid, p.path, bm25(fts_paths),
+                       highlight(fts_paths, 0, '[', ']')
+                FROM fts_paths p WHERE fts_paths MATCH ?
+                ORDER BY bm25(fts_paths) LIMIT ?"""),
+        ]
+        for match in (query, fts_literal(query)):
+            results: list[dict] = []
+            missing = 0
+            try:
+                for kind, sql in sources:
+                    try:
+                        rows = conn.execute(sql, (match, top)).fetchall()
+                    except sqlite3.OperationalError as e:
+                        # Column filters like 'risks:' only exist in fts_summaries
+                        if "no such column" not in str(e):
+                            raise
+                        missing += 1
+                        continue
+                    for rank, (rid, path, score, snip) in enumerate(rows, 1):
+                        results.append({"kind": kind, "id": rid, "path": path, "score": score, "rank": rank, "snippet": snip})
+            except sqlite3.OperationalError as e:
+                logging.debug(f"FTS query {match!r} rejected: {e}")
+                continue
+            if missing < len(sources):
+                break
+        else:
+            logging.warning(f"Search query {query!r} is not valid FTS5 syntax")
+            return []
+        order = {kind: i for i, (kind, _) in enumerate(sources)}
+        results.sort(key=lambda r: (r["rank"], order[r["kind"]]))
+        return results[:top]
+    finally:
+        conn.close()
+
+
+# ---------------------- Export / import ----------------------
+
+EXPORT_FORMAT = 2
+EXPORT_ACTION_COLS = [
+    "id", "action", "model", "backend", "prompt", "file_hash", "tokens_in", "tokens_out",
+    "status", "error", "created_at", "latency_ms", "dedup_of",
+]
+EXPORT_FILE_COLS = ["path", "ext", "first_seen", "last_seen", "last_hash"]
+
+
+EXPORT_PLAIN_SUFFIXES = (".ndjson", ".jsonl", ".json")
+
+
+def _open_ndjson(path: str, mode: str, name: str | None = None):
+    """Text handle for an NDJSON file. Writes are gzip-compressed unless `name`
+    (default: path) ends in .ndjson/.jsonl/.json; reads detect gzip by its magic bytes."""
+    if mode == "w":
+        gz = not (name or path).endswith(EXPORT_PLAIN_SUFFIXES)
+    else:
+        with open(path, "rb") as fh:
+            gz = fh.read(2) == b"\x1f\x8b"
+    if gz:
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def export_results(cfg: dict, path: str, after: int | None = None) -> dict:
+    """Stream files/actions/summaries/rewrites with action id > `after` to gzipped NDJSON
+    (plain text when `path` ends in .ndjson/.jsonl/.json).
+
+    One "header" line, then "file" lines for every file the exported actions touch, then
+    one "action" line per action with its summary, rewrite and diff inlined (path instead
+    of file_id, run host instead of run_id). Each action carries a stable "origin"
+    ("<host>:<id>" where it was first recorded), kept across re-exports of imported
+    rows, which import_results uses as its key. Rows are read from a single snapshot and
+    written as they are fetched. Without `after`, resumes from the export_watermark
+    state left by the previous export; the watermark only moves once the file is complete.
+    """
+    conn = db_connect(cfg["db_path"])
+    try:
+        if after is None:
+            after = int(db_get_state(conn, "export_watermark", "0") or 0)
+        stats = {"after": after, "through": after, "files": 0, "actions": 0}
+        tmp = path + ".part"
+        conn.execute("BEGIN")  # one read snapshot for the whole export
+        through = conn.execute("SELECT COALESCE(MAX(id), 0) FROM actions").fetchone()[0]
+        with _open_ndjson(tmp, "w", path) as out:
+            header = {
+                "type": "header", "format": EXPORT_FORMAT, "app": APP_NAME, "version": VERSION,
+                "host": socket.gethostname(), "exported_at": human_ts(), "after": after, "through": through,
+            }
+            out.write(json.dumps(header, ensure_ascii=False) + "\n")
+            cur = conn.execute(
+                f"SELECT {', '.join(EXPORT_FILE_COLS)} FROM files "
+                "WHERE id IN (SELECT file_id FROM actions WHERE id > ? AND id <= ?) ORDER BY id",
+                (after, through),
+            )
+            for row in cur:
+                rec = {"type": "file", **dict(zip(EXPORT_FILE_COLS, row))}
+                out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                stats["files"] += 1
+            cur = conn.execute(
+                f"""
+                SELECT {', '.join('a.' + c for c in EXPORT_ACTION_COLS)}, f.path, r.host,
+                       COALESCE(a.origin, COALESCE(r.host, :host) || ':' || a.id),
+                       s.summary, w.rewrite, w.diff
+                FROM actions a
+                LEFT JOIN files f ON f.id = a.file_id
+                LEFT JOIN runs r ON r.id = a.run_id
+                LEFT JOIN summaries s ON s.action_id = a.id
+                LEFT JOIN rewrites w ON w.action_id = a.id
+                WHERE a.id > :after AND a.id <= :through ORDER BY a.id
+                """,
+                {"host": header["host"], "after": after, "through": through},
+            )
+            for row in cur:
+                rec = {"type": "action", **dict(zip(EXPORT_ACTION_COLS + ["path", "host", "origin", "summary", "rewrite", "diff"], row))}
+                out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                stats["actions"] += 1
+        conn.rollback()
+        os.replace(tmp, path)
+        stats["through"] = through
+        db_set_state(conn, "export_watermark", str(through))
+    finally:
+        conn.close()
+    logging.info(f"Exported {stats['actions']} actions, {stats['files']} files (ids {stats['after']}+1..{stats['through']}) to {path}")
+    return stats
+
+
+def import_results(cfg: dict, path: str, batch_size: int = 500) -> dict:
+    """Merge an export_results() file into this DB; safe to rerun on the same file.
+
+    Files are matched by path (first_seen/last_seen widen, last_hash follows the newer
+    last_seen). An action is skipped when one with the same origin ("<host>:<id>" where
+    it was first recorded) is already here, either imported earlier or native to this
+    DB. New actions get fresh ids under one run per import and keep their origin;
+    dedup links are remapped through a temp table, or re-resolved by content hash when
+    the target came in an earlier export. latency_ms is not imported, since it measures
+    the source host's hardware. Commits every `batch_size` lines.
+    """
+    conn = db_connect(cfg["db_path"])
+    stats = {"files": 0, "actions": 0, "skipped": 0}
+    try:
+        ensure_fts(conn)
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS import_map (src_id INTEGER PRIMARY KEY, id INTEGER)")
+        conn.execute("DELETE FROM temp.import_map")
+        header = run_id = None
+        pending = 0
+        with _open_ndjson(path, "r") as fh:
+            for lineno, line in enumerate(fh, 1):
+                if not line.strip():
+                    continue
+                rec = json.loads(line)
+                kind = rec.get("type")
+                if kind == "header":
+                    if int(rec.get("format") or 0) > EXPORT_FORMAT:
+                        raise ValueError(f"{path}: export format {rec.get('format')} is newer than this walker supports")
+                    header = rec
+                elif kind == "file":
+                    cur = conn.execute(
+                        f"INSERT OR IGNORE INTO files({', '.join(EXPORT_FILE_COLS)}) VALUES(?,?,?,?,?)",
+                        tuple(rec.get(c) for c in EXPORT_FILE_COLS),
+                    )
+                    if not cur.rowcount:
+                        conn.execute(
+                            """
+                            UPDATE files SET
+                              first_seen = MIN(COALESCE(first_seen, :first_seen), COALESCE(:first_seen, first_seen)),
+                              last_hash = CASE WHEN :last_seen > COALESCE(last_seen, '') THEN :last_hash ELSE last_hash END,
+                              last_seen = MAX(COALESCE(last_seen, ''), COALESCE(:last_seen, ''))
+                            WHERE path = :path
+                            """,
+                            rec,
+                        )
+                    stats["files"] += 1
+                elif kind == "action":
+                    if header is None:
+                        raise ValueError(f"{path}:{lineno}: action before header")
+                    file_id = db_import_file_id(conn, rec)
+                    # Format 1 files carry no origin; derive it the way export_results does
+                    origin = rec.get("origin") or f"{rec.get('host') or header.get('host')}:{rec['id']}"
+                    dup = db_find_origin(conn, origin)
+                    if dup:
+                        conn.execute("INSERT OR REPLACE INTO temp.import_map(src_id,id) VALUES(?,?)", (rec["id"], dup))
+                        stats["skipped"] += 1
+                    else:
+                        if run_id is None:
+                            cur = conn.execute(
+                                "INSERT INTO runs(started_at,host,pid,config_json) VALUES(?,?,?,?)",
+                                (human_ts(), header.get("host"), os.getpid(),
+                                 json.dumps({"import": os.path.abspath(path), "source": header}, ensure_ascii=False)),
+                            )
+                            run_id = cur.lastrowid
+                        dedup_of = None
+                        if rec.get("dedup_of") is not None:
+                            row = conn.execute("SELECT id FROM temp.import_map WHERE src_id=?", (rec["dedup_of"],)).fetchone()
+                            dedup_of = row[0] if row else db_find_content_result(conn, rec.get("file_hash"), rec.get("action"), file_id)
+                        # latency_ms stays NULL: another host's hardware must not feed this
+                        # host's adaptive timeouts or --plan estimates
+                        values = dict(rec, latency_ms=None)
+                        cols = EXPORT_ACTION_COLS[1:-1]
+                        cur = conn.execute(
+                            f"INSERT INTO actions(run_id,file_id,{','.join(cols)},dedup_of,origin) VALUES(?,?,{','.join('?' * len(cols))},?,?)",
+                            (run_id, file_id, *(values.get(c) for c in cols), dedup_of, origin),
+                        )
+                        new_id = cur.lastrowid
+                        conn.execute("INSERT OR REPLACE INTO temp.import_map(src_id,id) VALUES(?,?)", (rec["id"], new_id))
+                        # Plain INSERT so the FTS triggers index the new rows (see FTS_DDL)
+                        if rec.get("summary") is not None:
+                            conn.execute("INSERT INTO summaries(action_id,summary) VALUES(?,?)", (new_id, rec["summary"]))
+                        if rec.get("rewrite") is not None or rec.get("diff") is not None:
+                            conn.execute(
+                                "INSERT INTO rewrites(action_id,rewrite,diff) VALUES(?,?,?)",
+                                (new_id, rec.get("rewrite"), rec.get("diff")),
+                            )
+                        stats["actions"] += 1
+                pending += 1
+                if pending >= batch_size:
+                    conn.commit()
+                    pending = 0
+        if run_id is not None:
+            conn.execute("UPDATE runs SET finished_at=? WHERE id=?", (human_ts(), run_id))
+        conn.commit()
+    finally:
+        conn.close()
+    logging.info(f"Imported {stats['actions']} actions ({stats['skipped']} already present), {stats['files']} files from {path}")
+    return stats
+
+
 # ---------------------- Main run ----------------------
 
-def run_once(cfg: dict) -> None:
-    # Locking
+def acquire_lock(cfg: dict) -> tuple[bool, int | None]:
+    """Take the non-blocking run lock. Returns (acquired, fd)."""
     lockfile = cfg.get("lockfile") or "/tmp/codewalker.lock"
     lock_fd = None
     try:
@@ -606,9 +1971,236 @@ def run_once(cfg: dict) -> None:
             fcntl.lockf(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
         except Exception:
             logging.info("Another CodeWalker run is active; exiting.")
-            return
+            os.close(lock_fd)
+            return False, None
     except Exception as e:
         logging.warning(f"Could not establish lock: {e}")
+    return True, lock_fd
+
+
+def release_lock(lock_fd: int | None) -> None:
+    try:
+        import fcntl
+        if lock_fd is not None:
+            fcntl.lockf(lock_fd, fcntl.LOCK_UN)
+    except Exception:
+        pass
+    if lock_fd is not None:
+        try:
+            os.close(lock_fd)
+        except Exception:
+            pass
+
+
+QUEUE_MODES = ("que", "queue", "queue-only", "queued")
+
+
+def change_marker_mtime(cfg: dict) -> float | None:
+    marker = cfg.get("change_marker")
+    if not marker:
+        return None
+    try:
+        return os.stat(marker).st_mtime
+    except OSError:
+        return None
+
+
+def needs_visit(last_seen: str | None, mtime: float) -> bool:
+    """True for a file that is new or modified since the walker last looked at it."""
+    if last_seen is None:
+        return True
+    try:
+        return int(mtime) > dt.datetime.fromisoformat(last_seen).timestamp()
+    except ValueError:
+        return True
+
+
+def tree_has_backlog(cfg: dict, conn: sqlite3.Connection) -> bool:
+    """True if any scan candidate still needs a visit (stops at the first one found).
+
+    Files run_once skips without recording (blank payload, unreadable) are ignored,
+    otherwise they would count as new forever.
+    """
+    for path, _ext, size, mtime in iter_candidates(cfg):
+        if not size:
+            continue
+        row = conn.execute("SELECT last_seen FROM files WHERE path=?", (path,)).fetchone()
+        if not needs_visit(row[0] if row else None, mtime):
+            continue
+        try:
+            if read_payload_for_model(path, cfg)[0].strip():
+                return True
+        except Exception:
+            continue
+    return False
+
+
+def idle_tick(cfg: dict) -> bool:
+    """Cheap pre-check for cron: True when there is provably nothing to do.
+
+    Uses one read-only SQLite connection and no third-party imports, and never
+    writes (no runs row, no DDL). Anything unexpected means "not idle" so the
+    normal path runs.
+    """
+    db_path = cfg.get("db_path")
+    if not db_path or not os.path.isfile(db_path):
+        return False
+    mode = str(cfg.get("mode") or "cron").strip().lower()
+    marker = change_marker_mtime(cfg) if mode not in QUEUE_MODES else None
+    if mode not in QUEUE_MODES and marker is None:
+        return False  # plain scan mode always has work
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=1)
+        try:
+            if conn.execute("SELECT 1 FROM queued_files WHERE status='pending' LIMIT 1").fetchone():
+                return False
+            if mode in QUEUE_MODES:
+                return True
+            row = conn.execute("SELECT value FROM walker_state WHERE key='change_marker_mtime'").fetchone()
+            return bool(row) and float(row[0]) >= marker
+        finally:
+            conn.close()
+    except (sqlite3.Error, ValueError):
+        return False
+
+
+def shard_key(cfg: dict, path: str, count: int) -> tuple[int, str]:
+    """(shard index, order key) for a path. Hashes the path relative to scan_path
+    so the assignment survives moving the tree."""
+    rel = os.path.relpath(os.path.abspath(path), os.path.abspath(cfg.get("scan_path") or "/"))
+    digest = hashlib.sha1(rel.encode("utf-8", errors="surrogateescape")).hexdigest()
+    return int(digest[:15], 16) % count, digest
+
+
+def shard_count(cfg: dict, conn: sqlite3.Connection) -> int:
+    """Configured `shards`, else the count chosen on the first shard run (kept stable)."""
+    configured = int(cfg.get("shards") or 0)
+    if configured > 0:
+        return configured
+    stored = db_get_state(conn, "shard_count")
+    if stored and int(stored) > 0:
+        return int(stored)
+    limit = max(1, int(cfg.get("limit_per_run") or 50))
+    total = sum(1 for _ in iter_candidates(cfg))
+    return max(1, math.ceil(total / limit))
+
+
+def claim_shard(cfg: dict, conn: sqlite3.Connection, run_id: int) -> dict | None:
+    """Atomically take the next unclaimed shard and advance the cursor.
+
+    State lives in walker_state: shard_count, shard_cursor, and shard:<i> holding
+    {"pos": last order key done, "run": claiming run id, "claimed": epoch}. Returns
+    None when every shard is claimed by live walkers.
+    """
+    count = shard_count(cfg, conn)
+    ttl_s = float(cfg.get("shard_claim_ttl_min") or 180) * 60
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if db_get_state(conn, "shard_count") != str(count):
+            # New or resized shard set: assignments changed, start over
+            conn.execute("DELETE FROM walker_state WHERE key LIKE 'shard:%' OR key='shard_cursor'")
+            conn.execute(
+                "INSERT OR REPLACE INTO walker_state(key,value,updated_at) VALUES('shard_count',?,?)",
+                (str(count), human_ts()),
+            )
+        cursor = int(db_get_state(conn, "shard_cursor", "0")) % count
+        for step in range(count):
+            index = (cursor + step) % count
+            state = json.loads(db_get_state(conn, f"shard:{index}", "{}"))
+            if state.get("run") and time.time() - float(state.get("claimed") or 0) < ttl_s:
+                continue
+            state.update(run=run_id, claimed=time.time())
+            conn.executemany(
+                "INSERT OR REPLACE INTO walker_state(key,value,updated_at) VALUES(?,?,?)",
+                [(f"shard:{index}", json.dumps(state), human_ts()),
+                 ("shard_cursor", str((index + 1) % count), human_ts())],
+            )
+            conn.commit()
+            return {"index": index, "count": count, "pos": state.get("pos") or "", "finished": False}
+        conn.commit()
+        return None
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def release_shard(conn: sqlite3.Connection, shard: dict) -> None:
+    """Drop the claim and store where the next visit to this shard resumes."""
+    pos = "" if shard.get("finished") else shard.get("pos", "")
+    db_set_state(conn, f"shard:{shard['index']}", json.dumps({"pos": pos, "run": None, "claimed": None}))
+
+
+def iter_shard(cfg: dict, items: Iterable[tuple[str, str, int, float]], shard: dict) -> Iterator[str]:
+    """Paths of one shard in stable hash order, after shard["pos"].
+
+    shard["pos"] advances only when the consumer asks for the next path, i.e.
+    after the previous one was handled, so a run stopped by limit_per_run
+    records exactly how far it got; shard["finished"] is set at the end.
+    """
+    members = []
+    for path, _ext, _size, _mtime in items:
+        index, key = shard_key(cfg, path, shard["count"])
+        if index == shard["index"] and key > shard["pos"]:
+            members.append((key, path))
+    members.sort()
+    for key, path in members:
+        yield path
+        shard["pos"] = key
+    shard["finished"] = True
+
+
+def select_candidates(
+    cfg: dict, conn: sqlite3.Connection, sample: bool = True, shard: dict | None = None
+) -> tuple[Iterator[str], dict[str, str]]:
+    """Return (lazy candidate paths, queue note map) for the configured mode.
+
+    Queued paths come first and are yielded before the tree walk starts, so queue
+    work begins immediately. With a claimed `shard` the scan stage is that shard's
+    remaining paths (see iter_shard). Otherwise, with sample=True it is either a
+    (weighted) reservoir sample of limit_per_run × sample_factor paths
+    (scan_order "random") or the files in walk order as they are found ("walk").
+    sample=False yields every candidate (for --plan).
+    """
+    mode = str(cfg.get("mode") or "cron").strip().lower()
+    queue_entries = db_get_pending_queue_paths(conn)
+    queue_paths = [entry[0] for entry in queue_entries]
+    queue_note_map: dict[str, str] = {}
+    for path, note in queue_entries:
+        clean = (note or "").strip()
+        if not clean:
+            continue
+        queue_note_map[path] = clean
+        queue_note_map[os.path.abspath(path)] = clean
+
+    def _stream() -> Iterator[str]:
+        yield from queue_paths
+        if mode in QUEUE_MODES:
+            # Process only queued files
+            return
+        # Scan directories as usual, after queued paths
+        seen = set(os.path.abspath(p) for p in queue_paths)
+        if not sample:
+            yield from (p for p in gather_candidates(cfg) if os.path.abspath(p) not in seen)
+            return
+        fresh = (c for c in iter_candidates(cfg) if os.path.abspath(c[0]) not in seen)
+        if shard is not None:
+            yield from iter_shard(cfg, fresh, shard)
+        elif str(cfg.get("scan_order") or "random").lower() == "walk":
+            # Walk order: fully lazy, the walk stops as soon as the run has enough files
+            yield from (c[0] for c in fresh)
+        else:
+            k = int(cfg.get("limit_per_run") or 50) * max(1, int(cfg.get("sample_factor") or 1))
+            weight = SAMPLE_WEIGHTS.get(str(cfg.get("sample_weight") or "uniform").lower(), SAMPLE_WEIGHTS["uniform"])
+            yield from reservoir_sample(fresh, k, weight)
+
+    return _stream(), queue_note_map
+
+
+def run_once(cfg: dict) -> None:
+    acquired, lock_fd = acquire_lock(cfg)
+    if not acquired:
+        return
 
     conn = db_connect(cfg["db_path"])
     cur = conn.cursor()
@@ -618,40 +2210,29 @@ def run_once(cfg: dict) -> None:
     )
     conn.commit()
     run_id = cur.lastrowid
+    latency = db_latency_profile(conn)
+    shard = None
 
     try:
         limit = int(cfg.get("limit_per_run") or 50)
         mode = str(cfg.get("mode") or "cron").strip().lower()
-        queue_entries = db_get_pending_queue_paths(conn)
-        queue_paths = [entry[0] for entry in queue_entries]
-        queue_note_map: dict[str, str] = {}
-        for path, note in queue_entries:
-            clean = (note or "").strip()
-            if not clean:
-                continue
-            queue_note_map[path] = clean
-            queue_note_map[os.path.abspath(path)] = clean
-
-        if mode in ("que", "queue", "queue-only", "queued"):
-            # Process only queued files
-            candidates = queue_paths
-        else:
-            # Scan directories as usual, but prioritize queued first
-            candidates = gather_candidates(cfg)
-            if queue_paths:
-                seen = set(os.path.abspath(p) for p in queue_paths)
-                prioritized = queue_paths[:]
-                for p in candidates:
-                    ap = os.path.abspath(p)
-                    if ap not in seen:
-                        prioritized.append(p)
-                candidates = prioritized
+        if cfg.get("deterministic_per_file") and mode not in QUEUE_MODES:
+            shard = claim_shard(cfg, conn, run_id)
+            if shard is None:
+                logging.info("All shards are claimed by other walkers; processing the queue only.")
+                mode = "queue"
+                cfg = dict(cfg, mode=mode)
+            else:
+                logging.info(f"Shard {shard['index'] + 1}/{shard['count']}" + (" (resuming)" if shard["pos"] else ""))
+        candidates, queue_note_map = select_candidates(cfg, conn, shard=shard)
+        marker_mtime = change_marker_mtime(cfg) if mode not in QUEUE_MODES else None
         processed = 0
-        logging.info(f"Found {len(candidates)} candidate files")
+        considered = 0
 
         for path in candidates:
             if processed >= limit:
                 break
+            considered += 1
             try:
                 payload, ext = read_payload_for_model(path, cfg)
                 if not payload.strip():
@@ -662,17 +2243,29 @@ def run_once(cfg: dict) -> None:
                 hsh = sha256_bytes(full_bytes)
                 file_id = db_get_or_create_file(conn, path, ext, hsh)
 
-                # Skip unchanged if last action already saw this hash recently (optional)
-                # (We always log action to see cadence; you can add a dedup check if desired.)
-
                 # Decide action
                 do_rewrite = random.randint(1, 100) <= int(cfg.get("percent_rewrite") or 25)
                 action = "rewrite" if (do_rewrite and ext in CODE_LIKE_EXT) else "summarize"
 
+                queue_note = queue_note_map.get(path) or queue_note_map.get(os.path.abspath(path))
+
+                # Identical content already processed at another path: link instead of calling the model.
+                # Queue notes carry per-file instructions, so those always go to the model.
+                if cfg.get("dedup_content", True) and not queue_note:
+                    src_id = db_find_content_result(conn, hsh, action, file_id)
+                    if src_id:
+                        db_insert_action(
+                            conn, run_id, file_id, action, cfg.get("model"), "dedup", "", hsh, "dedup", None, None, None, None, src_id
+                        )
+                        conn.execute("UPDATE queued_files SET status='done' WHERE path=? AND status='pending'", (path,))
+                        conn.commit()
+                        logging.info(f"Dedup {path}: same content as action #{src_id}")
+                        continue
+
                 # Build prompts
                 file_meta = f"File: {path}\nExt: {ext}\nSize: {len(full_bytes)} bytes\nLastModified: {human_ts(os.path.getmtime(path))}\n"
-
-                queue_note = queue_note_map.get(path) or queue_note_map.get(os.path.abspath(path))
+                full_text = full_bytes.decode("utf-8", errors="ignore")
+                regions = None
 
                 if action == "summarize":
                     prompt_used = SUMMARIZE_INSTR
@@ -694,18 +2287,34 @@ def run_once(cfg: dict) -> None:
                     else:
                         chosen = random.choice(prompts) if prompts else (cfg.get("rewrite_prompt") or "Make this code more readable and modular.")
                         logging.info("Using rewrite prompt: %s", chosen)
-                    prompt_used = f"{REWRITE_INSTR_PREFIX} {chosen}".strip()
-                    #logging.info("Using rewrite prompt: %s", prompt_used)
-                    safe_payload = payload.replace("```", "``\\`")
-                    messages = [
-                        {"role": "system", "content": prompt_used},
-                        {"role": "user", "content": f"{file_meta}\nRewrite the entire file below.\n```{ext}\n{safe_payload}\n```"},
-                    ]
-
-
+                    regions = plan_incremental(cfg, conn, file_id, hsh, full_text, ext)
+                    if regions:
+                        # Only what changed since the last successful action goes to the model
+                        context = int((cfg.get("incremental_rewrite") or {}).get("context_lines", 3))
+                        prompt_used = f"{REGION_INSTR_PREFIX} {chosen}".strip()
+                        messages = [
+                            {"role": "system", "content": prompt_used},
+                            {"role": "user", "content": f"{file_meta}\nRewrite these {len(regions)} changed region(s).\n\n"
+                                                        + region_prompt(full_text.split("\n"), regions, ext, context)},
+                        ]
+                        logging.info("Incremental rewrite of %s: lines %s", path, ", ".join(f"{a + 1}-{b}" for a, b in regions))
+                    else:
+                        prompt_used = f"{REWRITE_INSTR_PREFIX} {chosen}".strip()
+                        #logging.info("Using rewrite prompt: %s", prompt_used)
+                        safe_payload = payload.replace("```", "``\\`")
+                        messages = [
+                            {"role": "system", "content": prompt_used},
+                            {"role": "user", "content": f"{file_meta}\nRewrite the entire file below.\n```{ext}\n{safe_payload}\n```"},
+                        ]
+
+
+                rcfg = resolve_route(cfg, action, ext, estimate_tokens(prompt_used + messages[-1]["content"]))
+                model_used = rcfg.get("model")
+                t0 = time.monotonic()
                 try:
-                    text, meta = llm_chat(cfg, messages, model=cfg.get("model"))
-                    backend = meta.get("backend", cfg.get("backend"))
+                    text, meta = llm_chat(rcfg, messages, model=rcfg.get("model"), latency=latency)
+                    backend = meta.get("backend", rcfg.get("backend"))
+                    model_used = meta.get("model") or model_used
                     usage = meta.get("usage") or {}
                     tokens_in = usage.get("prompt_tokens")
                     tokens_out = usage.get("completion_tokens")
@@ -713,13 +2322,22 @@ def run_once(cfg: dict) -> None:
                     err = None
                 except Exception as e:
                     text = ""
-                    backend = cfg.get("backend")
+                    backend = rcfg.get("backend")
                     tokens_in = tokens_out = None
                     status = "error"
                     err = str(e)
 
+                latency_ms = int((time.monotonic() - t0) * 1000)
+
+                spliced = None
+                if status == "ok" and regions:
+                    spliced, replaced = splice_regions(full_text.split("\n"), regions, text)
+                    if not replaced:
+                        status = "error"
+                        err = "incremental rewrite: reply contained no region blocks"
+
                 action_id = db_insert_action(
-                    conn, run_id, file_id, action, cfg.get("model"), backend, prompt_used, hsh, status, err, tokens_in, tokens_out
+                    conn, run_id, file_id, action, model_used, backend, prompt_used, hsh, status, err, tokens_in, tokens_out, latency_ms
                 )
 
                 if status == "ok":
@@ -732,20 +2350,23 @@ def run_once(cfg: dict) -> None:
                         except Exception:
                             # Wrap as JSON
                             summary_text = json.dumps({"raw": text}, ensure_ascii=False)
-                        conn.execute("INSERT OR REPLACE INTO summaries(action_id,summary) VALUES(?,?)", (action_id, summary_text))
+                        conn.execute("INSERT INTO summaries(action_id,summary) VALUES(?,?)", (action_id, summary_text))
+                        if (cfg.get("embeddings") or {}).get("enabled"):
+                            embed_summary(conn, cfg, action_id, path, summary_text)
                     else:
                         # rewrite: try to extract code block; fallback to full text
                         body = text
                         blk = extract_first_codeblock(text)
                         if blk:
                             body = blk[1]
-                        new_text = body
-                        old_text = full_bytes.decode("utf-8", errors="ignore")
-                        diff = unified_diff(old_text, new_text, path, path + ".rewritten")
+                        new_text = spliced if spliced is not None else body
+                        diff = unified_diff(full_text, new_text, path, path + ".rewritten")
                         conn.execute(
-                            "INSERT OR REPLACE INTO rewrites(action_id,rewrite,diff) VALUES(?,?,?)",
+                            "INSERT INTO rewrites(action_id,rewrite,diff) VALUES(?,?,?)",
                             (action_id, new_text, diff),
                         )
+                    if (cfg.get("incremental_rewrite") or {}).get("enabled"):
+                        db_store_snapshot(conn, file_id, hsh, action_id, full_bytes)
                 else:
                     logging.warning(f"Action failed for {path}: {err}")
 
@@ -761,25 +2382,192 @@ def run_once(cfg: dict) -> None:
             except Exception as e:
                 logging.exception(f"Unhandled error processing {path}: {e}")
                 continue
-
-        logging.info(f"Processed {processed} files (limit {limit})")
+        candidates.close()  # stop the tree walk (and its thread pool) now, not at GC
+
+        logging.info(f"Processed {processed} files (limit {limit}, {considered} candidates considered)")
+        if shard is not None and not (shard["finished"] and shard["index"] == shard["count"] - 1):
+            marker_mtime = None  # the tree counts as seen only once a full rotation is done
+        elif shard is None and marker_mtime is not None and tree_has_backlog(cfg, conn):
+            # A run covers only limit_per_run files; ticks stay active until the rest are visited
+            marker_mtime = None
+        if marker_mtime is not None:
+            db_set_state(conn, "change_marker_mtime", repr(marker_mtime))
+        if shard is not None:
+            release_shard(conn, shard)
+            shard = None
 
     finally:
+        if shard is not None:
+            # Unexpected exit: give the shard back (its position is still valid)
+            shard["finished"] = False
+            release_shard(conn, shard)
         cur.execute("UPDATE runs SET finished_at=? WHERE id=?", (human_ts(), run_id))
         conn.commit()
         conn.close()
-        # release lock
-        try:
-            import fcntl
-            if lock_fd is not None:
-                fcntl.lockf(lock_fd, fcntl.LOCK_UN)
-        except Exception:
-            pass
-        if lock_fd is not None:
-            try:
-                os.close(lock_fd)
-            except Exception:
-                pass
+        release_lock(lock_fd)
+
+
+# ---------------------- Planning ----------------------
+
+def fmt_duration(seconds: float) -> str:
+    seconds = int(max(0, seconds))
+    h, rem = divmod(seconds, 3600)
+    m, s = divmod(rem, 60)
+    return f"{h}h{m:02d}m" if h else f"{m}m{s:02d}s"
+
+
+def action_history(conn: sqlite3.Connection, backend: str | None, model: str | None, window: int = 500) -> dict:
+    """Per-action latency/throughput from recent ok actions, preferring the configured
+    backend+model and falling back to all history."""
+    def _rows(where: str, params: tuple) -> list:
+        return conn.execute(
+            f"SELECT action, latency_ms, tokens_in, tokens_out FROM actions WHERE status='ok' AND latency_ms > 0 {where} "
+            "ORDER BY id DESC LIMIT ?",
+            params + (window,),
+        ).fetchall()
+
+    rows = _rows("AND backend=? AND model=?", (backend, model)) if backend and model else []
+    if len(rows) < 5 and model:
+        rows = _rows("AND model=?", (model,))
+    if len(rows) < 5:
+        rows = _rows("", ())
+    hist: dict = {}
+    for action in ("summarize", "rewrite"):
+        sel = [r for r in rows if r[0] == action]
+        tok = [r for r in sel if r[2]]
+        ms_total = sum(r[1] for r in tok)
+        hist[action] = {
+            "n": len(sel),
+            "p50_ms": percentile([r[1] for r in sel], 50),
+            "p95_ms": percentile([r[1] for r in sel], 95),
+            "p50_ms_per_tok": percentile([r[1] / r[2] for r in tok], 50),
+            "p95_ms_per_tok": percentile([r[1] / r[2] for r in tok], 95),
+            "tok_per_s": (sum(r[2] + (r[3] or 0) for r in tok) * 1000.0 / ms_total) if ms_total else 0.0,
+        }
+    return hist
+
+
+def estimate_seconds(h: dict, est_tokens: int, pct: int) -> float:
+    if h["n"] == 0:
+        return 0.0
+    if h[f"p{pct}_ms_per_tok"]:
+        return h[f"p{pct}_ms_per_tok"] * est_tokens / 1000.0
+    return h[f"p{pct}_ms"] / 1000.0
+
+
+def plan_run(cfg: dict) -> dict:
+    """Dry run: select candidates, estimate tokens and duration from history, and
+    recommend a limit_per_run that fits the cron interval. Never calls the model."""
+    conn = db_connect(cfg["db_path"])
+    try:
+        mode = str(cfg.get("mode") or "cron").strip().lower()
+        limit = int(cfg.get("limit_per_run") or 50)
+        interval_s = float(cfg.get("cron_interval_min") or 20) * 60
+        pct_rewrite = max(0, min(100, int(cfg.get("percent_rewrite") or 0))) / 100.0
+        stream, _ = select_candidates(cfg, conn, sample=False)
+        candidates = list(stream)
+        queued = conn.execute("SELECT COUNT(*) FROM queued_files WHERE status='pending'").fetchone()[0]
+
+        if mode in QUEUE_MODES:
+            backlog = len(candidates)
+        else:
+            last_seen = {p: ts for p, ts in conn.execute("SELECT path, last_seen FROM files")}
+            backlog = 0
+            for p in candidates:
+                try:
+                    backlog += needs_visit(last_seen.get(p), os.path.getmtime(p))
+                except OSError:
+                    backlog += 1
+
+        shards = None
+        if cfg.get("deterministic_per_file") and mode not in QUEUE_MODES:
+            count = int(cfg.get("shards") or 0) or int(db_get_state(conn, "shard_count", "0"))
+            count = count or max(1, math.ceil(len(candidates) / max(1, limit)))
+            sizes = collections.Counter(shard_key(cfg, p, count)[0] for p in candidates)
+            shards = {
+                "count": count,
+                "cursor": int(db_get_state(conn, "shard_cursor", "0")) % count,
+                "largest": max(sizes.values()) if sizes else 0,
+            }
+
+        hist = action_history(conn, cfg.get("backend"), cfg.get("model"))
+        route_hist: dict[tuple, dict] = {}
+
+        def _hist_for(action: str, ext: str, est: int) -> dict:
+            # Routed files are priced with their route's model history
+            rcfg = resolve_route(cfg, action, ext, est)
+            key = (rcfg.get("backend"), rcfg.get("model"))
+            if key not in route_hist:
+                route_hist[key] = action_history(conn, *key)
+            return route_hist[key][action]
+
+        overhead = estimate_tokens(SUMMARIZE_INSTR) + 60
+        sample = candidates[: max(limit, 50)]
+        per_file_p50: list[float] = []
+        per_file_p95: list[float] = []
+        tokens: list[int] = []
+        for p in sample:
+            payload, ext = read_payload_for_model(p, cfg)
+            if not payload.strip():
+                continue
+            est = estimate_tokens(payload) + overhead
+            tokens.append(est)
+            pr = pct_rewrite if ext in CODE_LIKE_EXT else 0.0
+            for out, pct in ((per_file_p50, 50), (per_file_p95, 95)):
+                out.append(pr * estimate_seconds(_hist_for("rewrite", ext, est), est, pct)
+                           + (1 - pr) * estimate_seconds(_hist_for("summarize", ext, est), est, pct))
+    finally:
+        conn.close()
+
+    n_next = min(limit, len(tokens))
+    avg_p50 = sum(per_file_p50) / len(per_file_p50) if per_file_p50 else 0.0
+    avg_p95 = sum(per_file_p95) / len(per_file_p95) if per_file_p95 else 0.0
+    runs_to_drain = math.ceil(backlog / limit) if limit > 0 else 0
+    plan = {
+        "mode": mode,
+        "candidates": len(candidates),
+        "queued": queued,
+        "backlog": backlog,
+        "limit": limit,
+        "next_run_files": n_next,
+        "next_run_tokens_in": sum(tokens[:n_next]),
+        "next_run_s_p50": sum(per_file_p50[:n_next]),
+        "next_run_s_p95": sum(per_file_p95[:n_next]),
+        "avg_file_s_p50": avg_p50,
+        "avg_file_s_p95": avg_p95,
+        "runs_to_drain": runs_to_drain,
+        "drain_s": runs_to_drain * interval_s,
+        "history": hist,
+        "shards": shards,
+        # Size the run so its p95 fits in 80% of the interval (no overlap, little idle GPU)
+        "recommended_limit": max(1, int(interval_s * 0.8 // avg_p95)) if avg_p95 > 0 else None,
+    }
+    return plan
+
+
+def print_plan(cfg: dict, plan: dict) -> None:
+    print(f"Plan: mode={plan['mode']} backend={cfg.get('backend')} model={cfg.get('model')} interval={cfg.get('cron_interval_min') or 20}m")
+    print(f"  candidates: {plan['candidates']}  backlog (new/changed or queued): {plan['backlog']}  pending queue: {plan['queued']}")
+    for action, h in plan["history"].items():
+        if h["n"]:
+            print(f"  history {action:<9}: {h['n']} samples, p50 {h['p50_ms'] / 1000:.1f}s p95 {h['p95_ms'] / 1000:.1f}s, {h['tok_per_s']:.1f} tok/s")
+        else:
+            print(f"  history {action:<9}: no samples")
+    print(f"  next run: {plan['next_run_files']} files, ~{plan['next_run_tokens_in']} input tokens, "
+          f"est {fmt_duration(plan['next_run_s_p50'])} (p95 {fmt_duration(plan['next_run_s_p95'])})")
+    print(f"  per file: p50 {plan['avg_file_s_p50']:.1f}s p95 {plan['avg_file_s_p95']:.1f}s")
+    print(f"  drain backlog: {plan['runs_to_drain']} runs at limit {plan['limit']} ≈ {fmt_duration(plan['drain_s'])}")
+    shards = plan.get("shards")
+    if shards:
+        # A shard bigger than the limit takes several runs, resumed in order
+        runs = shards["count"] * max(1, math.ceil(shards["largest"] / max(1, plan["limit"])))
+        interval_s = float(cfg.get("cron_interval_min") or 20) * 60
+        print(f"  shards: {shards['count']} (next {shards['cursor'] + 1}, largest {shards['largest']} files); "
+              f"full coverage within {runs} runs ≈ {fmt_duration(runs * interval_s)}")
+    if plan["recommended_limit"] is not None:
+        print(f"  recommended limit_per_run: {plan['recommended_limit']}")
+    else:
+        print("  recommended limit_per_run: n/a (no latency history yet)")
 
 
 # ---------------------- CLI ----------------------
@@ -790,11 +2578,33 @@ def main():
     parser.add_argument("--limit", type=int, default=None, help="Override per‑run file limit")
     parser.add_argument("--percent-rewrite", type=int, default=None, help="Override rewrite percentage (0‑100)")
     parser.add_argument("--once", action="store_true", help="Run one pass immediately (default)")
+    parser.add_argument("--plan", action="store_true", help="Dry run: estimate tokens/duration for the next run and backlog, recommend a limit")
+    parser.add_argument("--dupes", action="store_true", help="List groups of paths with identical content")
+    parser.add_argument("--maintain", action="store_true", help="Apply retention, roll up old actions, vacuum and analyze the DB")
+    parser.add_argument("--search", metavar="QUERY", default=None, help="Full-text search summaries, rewrites and paths (FTS5 syntax, e.g. 'risks: \"sql injection\"')")
+    parser.add_argument("--top", type=int, default=20, help="Max results for --search/--similar")
+    parser.add_argument("--embed", action="store_true", help="Embed summaries that have no vector yet (up to --limit, default 100)")
+    parser.add_argument("--similar", metavar="PATH", default=None, help="Files whose summaries are closest to PATH's (embedding index)")
+    parser.add_argument("--similar-text", metavar="TEXT", default=None, help="Summaries closest to free text (embedding index)")
+    parser.add_argument("--export", metavar="PATH", default=None, help="Write files/actions/summaries/rewrites newer than the last export as gzipped NDJSON (plain if PATH ends in .ndjson/.jsonl)")
+    parser.add_argument("--after", type=int, default=None, help="With --export: start after this action id instead of the saved watermark (0 = everything)")
+    parser.add_argument("--import", dest="import_path", metavar="PATH", default=None, help="Merge an --export file into this DB (idempotent)")
     args = parser.parse_args()
 
+    tool_mode = args.search is not None or args.similar is not None or args.similar_text is not None or args.embed or args.maintain or args.dupes or args.plan
+    tool_mode = tool_mode or args.export is not None or args.import_path is not None
+    if not tool_mode and idle_tick(load_config(args.config)):
+        return  # idle cron tick: nothing queued and the tree marker is unchanged
+
     load_env()
     cfg = load_config(args.config)
 
+    if args.search is not None:
+        for r in search_index(cfg, args.search, args.top):
+            snippet = " ".join((r["snippet"] or "").split())
+            print(f"{r['kind']:<7} {r['rank']:>3}. #{r['id']:<6} {r['path'] or '?'}  (bm25 {r['score']:.2f})\n          {snippet}")
+        return
+
     # CLI overrides
     if args.limit is not None:
         cfg["limit_per_run"] = args.limit
@@ -802,10 +2612,51 @@ def main():
     if args.percent_rewrite is not None:
         cfg["percent_rewrite"] = max(0, min(100, args.percent_rewrite))
 
+    if args.dupes:
+        conn = db_connect(cfg["db_path"])
+        try:
+            for content_hash, copies, paths in conn.execute("SELECT * FROM vw_content_groups ORDER BY copies DESC"):
+                print(f"{copies}x {content_hash[:12]}")
+                for p in sorted(paths.split("\n")):
+                    print(f"    {p}")
+        finally:
+            conn.close()
+        return
+
+    if args.similar is not None or args.similar_text is not None:
+        for score, p, action_id in similar_search(cfg, args.similar, args.similar_text, args.top):
+            print(f"{score:6.3f}  #{action_id:<6} {p}")
+        return
+
+    if args.plan:
+        print_plan(cfg, plan_run(cfg))
+        return
+
     setup_logging(cfg["log_path"])
     logging.info(f"Starting {APP_NAME} v{VERSION} | backend={cfg.get('backend')} model={cfg.get('model')}")
     logging.info(f"Scan: {cfg.get('scan_path')}  types={cfg.get('file_types')}  exclude={cfg.get('exclude_dirs')} exclude_files={cfg.get('exclude_files')}")
 
+    if args.embed:
+        embed_backfill(cfg, args.limit or 100)
+        return
+
+    if args.export is not None:
+        export_results(cfg, args.export, args.after)
+        return
+
+    if args.import_path is not None:
+        import_results(cfg, args.import_path)
+        return
+
+    if args.maintain:
+        acquired, lock_fd = acquire_lock(cfg)
+        if acquired:
+            try:
+                maintain_db(cfg)
+            finally:
+                release_lock(lock_fd)
+        return
+
     run_once(cfg)
 
 
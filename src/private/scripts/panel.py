@@ -1,178 +1,889 @@
-#!/usr/bin/env python3
-"""
-panel.py – A simple terminal‑based control panel for the T5600 AI system.
-
-The original implementation used Tkinter to create a GUI, but that
-requires a graphical environment which is not available on many
-headless servers.  This rewrite uses the standard `curses` library,
-so it can run in any terminal session (including SSH).
-
-Features
---------
-* A scrollable menu of actions.
-* Each action runs an external command via subprocess.Popen.
-* The interface updates immediately after a command finishes.
-
-Author: CodeWalker
-"""
-
-import curses
-import subprocess
-from typing import List, Tuple
-
-# --------------------------------------------------------------------------- #
-# Configuration – commands to run for each menu item
-# --------------------------------------------------------------------------- #
-
-Command = Tuple[str, str]  # (display text, shell command)
-
-#detect if apache or nginx is installed
-# if apache is installed use systemctl restart apache2
-# if nginx is installed use systemctl restart nginx
-
-if subprocess.run("which apache2", shell=True, capture_output=True).returncode == 0:
-    RESTART_COMMAND = "systemctl restart apache2"
-elif subprocess.run("which nginx", shell=True, capture_output=True).returncode == 0:
-    RESTART_COMMAND = "systemctl restart nginx"
-else:
-    RESTART_COMMAND = "echo 'No web server found'"
-
-
-
-COMMANDS: List[Command] = [
-    # --- Web / PHP-FPM ---
-    (" Test Nginx Config",          'sudo nginx -t'),
-    (" Reload Nginx",               'sudo systemctl reload nginx'),
-    (" Restart PHP-FPM",            'sudo systemctl restart php8.2-fpm'),
-    (" Restart Web Server",         f'sudo {RESTART_COMMAND}'),
-    (" Nginx Version",              'nginx -v 2>&1'),
-    (" PHP Version",                'php -v | head -1'),
-
-    # --- Logs & Timers (non-blocking snapshots) ---
-    (" Tail Nginx Access (200)",    'tail -n 200 /var/log/nginx/access.log'),
-    (" Tail Nginx Error (200)",     'tail -n 200 /var/log/nginx/error.log'),
-    (" Tail App Log (200)",         'tail -n 200 /var/www/html/admin/php_mc/src/private/logs/codewalker.log'),
-    (" List systemd Timers",        'systemctl list-timers --all | sed -n "1,40p"'),
-
-    # --- Codewalker service (systemd) ---
-    (" Run Codewalker Now",         'sudo systemctl start codewalker.service'),
-    (" Codewalker Journal (100)",   'sudo journalctl -u codewalker.service -n 100 --no-pager'),
-
-    # --- Repo helpers ---
-    (" Pull master (deploy)",       '/var/www/html/admin/php_mc/scripts/pull_master.sh'),
-    (" Push master (quick)",        '/var/www/html/admin/php_mc/scripts/push_master.sh'),
-
-    # --- Lints / Health ---
-    (" PHP Lint repo (7.4)",        "docker run --rm -v \"$PWD\":/app -w /app php:7.4-cli bash -lc 'git ls-files -z \"*.php\" \":(exclude)vendor/**\" \":(exclude)old/**\" | xargs -0 -n1 php -l'"),
-    (" Python Compile *.py",        "git ls-files -z '*.py' ':(exclude)old/**' | xargs -0 -n1 python3 -m py_compile"),
-
-    # --- System snapshots ---
-    (" Open Ports",                 'ss -tulpen | head -n 40'),
-    (" Disk Usage",                 'df -hT | sort -k6'),
-    (" Top Processes (1-shot)",     'ps aux --sort=-%cpu | head -n 15'),
-
-    # --- Ollama / LM Studio quick checks ---
-    (" Ping Ollama",                'curl -s http://127.0.0.1:11434/api/tags | head'),
-    (" Ping LM Studio",             'curl -s http://127.0.0.1:1234/v1/models | head'),
-
-    # --- Maintenance ---
-    (" Fix Dir Perms",              '/var/www/html/admin/php_mc/scripts/dirperm-hourly.sh'),
-    (" Backup notes.db",            "ts=$(date +%Y%m%d-%H%M%S); cp -a src/private/db/notes.db src/private/db/notes.db.$ts.bak && echo Backed up as notes.db.$ts.bak"),
-]
-# --------------------------------------------------------------------------- #
-# Helper functions
-# --------------------------------------------------------------------------- #
-
-def run_command(cmd: str) -> None:
-    """
-    Execute a shell command asynchronously.
-
-    Parameters
-    ----------
-    cmd : str
-        The command to execute.  It is passed directly to the shell.
-    """
-    subprocess.Popen(cmd, shell=True)
-
-
-def draw_menu(stdscr, selected_idx: int) -> None:
-    """
-    Render the menu on the screen.
-
-    Parameters
-    ----------
-    stdscr : curses.window
-        The main window object.
-    selected_idx : int
-        Index of the currently highlighted item.
-    """
-    stdscr.clear()
-    height, width = stdscr.getmaxyx()
-
-    title = "🛠️ T5600 AI Control Panel"
-    stdscr.attron(curses.color_pair(2))
-    stdscr.addstr(1, (width - len(title)) // 2, title)
-    stdscr.attroff(curses.color_pair(2))
-
-    for idx, (label, _) in enumerate(COMMANDS):
-        y = 3 + idx
-        if y >= height - 1:
-            break  # Don't write past the bottom of the screen
-
-        if idx == selected_idx:
-            stdscr.attron(curses.A_REVERSE)
-
-        stdscr.addstr(y, 4, label)
-        stdscr.attroff(curses.A_REVERSE)
-
-    stdscr.refresh()
-
-
-def main(stdscr: curses.window) -> None:
-    """
-    Main event loop for the panel.
-
-    Parameters
-    ----------
-    stdscr : curses.window
-        The main window object.
-    """
-    # Initialise colour pairs (foreground, background)
-    curses.start_color()
-    curses.init_pair(1, curses.COLOR_WHITE, curses.COLOR_BLACK)  # default
-    curses.init_pair(2, curses.COLOR_GREEN, curses.COLOR_BLACK)  # title
-
-    selected = 0
-    draw_menu(stdscr, selected)
-
-    while True:
-        key = stdscr.getch()
-
-        if key in (curses.KEY_UP, ord("k")) and selected > 0:
-            selected -= 1
-        elif key in (curses.KEY_DOWN, ord("j")) and selected < len(COMMANDS) - 1:
-            selected += 1
-        elif key in (ord("\n"), curses.KEY_ENTER):
-            # Execute the chosen command
-            _, cmd = COMMANDS[selected]
-            run_command(cmd)
-            # Brief pause so the user sees the menu again
-            stdscr.addstr(
-                len(COMMANDS) + 5,
-                4,
-                f"Started: {cmd}",
-                curses.color_pair(1),
-            )
-            stdscr.refresh()
-        elif key in (ord("q"), 27):  # 'q' or ESC to quit
-            break
-
-        draw_menu(stdscr, selected)
-
-
-# --------------------------------------------------------------------------- #
-# Entry point
-# --------------------------------------------------------------------------- #
-
-if __name__ == "__main__":
-    curses.wrapper(main)
+#!/usr/bin/env python3
+"""
+panel.py – A simple terminal‑based control panel for the T5600 AI system.
+
+The original implementation used Tkinter to create a GUI, but that
+requires a graphical environment which is not available on many
+headless servers.  This rewrite uses the standard `curses` library,
+so it can run in any terminal session (including SSH).
+
+Features
+--------
+* A scrollable, filterable menu of actions loaded from
+  src/private/panel_commands.json (next to mc_menu.json).
+* Each action runs as a background job; stdout/stderr are captured through
+  non-blocking pipes (polled with `selectors`) into a per-job ring buffer.
+  Jobs have no terminal (own session, stdin from /dev/null), so sudo cannot
+  ask for a password: menu commands use `sudo -n` and need a NOPASSWD
+  sudoers rule; a job that fails for lack of one says so in its output.
+* A job list shows running/finished jobs with exit codes and durations, and
+  an output pane shows the selected job's output.
+* A CodeWalker dashboard (key d) that polls codewalker.db read-only:
+  pending queue, files/hour, tokens/sec and latency percentiles per
+  model/backend, error rate and the current run.
+
+Rendering is split into regions (header, menu pad, right column, status
+line) and only regions that changed are redrawn, so keypresses over a slow
+SSH link cost a few bytes rather than a full repaint.
+
+Keys: Up/Down or j/k select, / starts a type-ahead filter (Esc clears it),
+Enter runs, Tab cycles the job shown in the output pane, PgUp/PgDn/Home/End
+scroll it, c cancels that job, d toggles the dashboard, q quits.
+
+Author: CodeWalker
+"""
+
+import codecs
+import collections
+import curses
+import datetime as dt
+import functools
+import json
+import math
+import os
+import re
+import selectors
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Deque, Dict, List, NamedTuple, Optional, Tuple
+
+# --------------------------------------------------------------------------- #
+# Configuration – commands to run for each menu item
+# --------------------------------------------------------------------------- #
+
+Command = Tuple[str, str]  # (display text, shell command)
+
+# Menu entries: [{"label": ..., "command": ...}, ...]; entries without a
+# command (e.g. {"_comment": "section"}) are skipped.
+COMMANDS_PATH = Path(__file__).resolve().parent.parent / "panel_commands.json"
+
+
+@functools.lru_cache(maxsize=None)
+def web_restart_command() -> str:
+    """Restart command for whichever web server is installed (looked up once,
+    on first use, so start-up never waits on it)."""
+    if shutil.which("apache2"):
+        return "systemctl restart apache2"
+    if shutil.which("nginx"):
+        return "systemctl restart nginx"
+    return "echo 'No web server found'"
+
+
+def expand_command(cmd: str) -> str:
+    """Fill placeholders in a menu command; only {web_restart} for now."""
+    if "{web_restart}" in cmd:
+        cmd = cmd.replace("{web_restart}", web_restart_command())
+    return cmd
+
+
+def load_commands(path: Path = COMMANDS_PATH) -> Tuple[List[Command], Optional[str]]:
+    """
+    Read the menu from JSON.
+
+    Returns
+    -------
+    tuple
+        (commands, error) – error is a message for the status line when the
+        file is missing or malformed, in which case commands is empty.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            entries = json.load(fh)
+    except (OSError, ValueError) as exc:
+        return [], f"Cannot load {path}: {exc}"
+    commands = [
+        (str(entry["label"]), str(entry["command"]))
+        for entry in entries
+        if isinstance(entry, dict) and entry.get("label") and entry.get("command")
+    ]
+    return commands, None
+
+
+OUTPUT_LINES = 2000     # ring buffer size per job
+JOB_HISTORY = 20        # finished jobs kept in the job list
+CANCEL_GRACE_S = 3.0    # SIGTERM, then SIGKILL after this long
+MENU_WIDTH = 34         # left column; jobs and output use the rest
+JOB_ROWS = 6            # visible rows in the job list
+
+CODEWALKER_CONFIG = "/var/www/html/admin/php_mc/src/private/codewalker.json"
+CODEWALKER_DB = "/var/www/html/admin/php_mc/src/private/db/codewalker.db"
+DASH_REFRESH_S = 3.0    # dashboard poll interval while it is visible
+DASH_WINDOW_S = 3600    # throughput/latency/error metrics cover the last hour
+DASH_SEED_ROWS = 5000   # newest actions read when the dashboard first opens
+
+# sudo -n (or sudo without a tty) refusing to prompt for a password
+SUDO_DENIED_RE = re.compile(r"sudo: (a password is required|a terminal is required)")
+SUDO_HINT = "panel: this action needs passwordless sudo (add a NOPASSWD sudoers rule for it)"
+
+ANSI_RE = re.compile(r"\x1b\[[0-9;?]*[ -/]*[@-~]")
+
+# --------------------------------------------------------------------------- #
+# Job manager
+# --------------------------------------------------------------------------- #
+
+@dataclass
+class Job:
+    """One command started from the menu, plus its captured output."""
+
+    id: int
+    label: str
+    cmd: str
+    proc: subprocess.Popen
+    started: float = field(default_factory=time.monotonic)
+    ended: Optional[float] = None
+    returncode: Optional[int] = None
+    cancelled_at: Optional[float] = None
+    # (is_stderr, text); oldest lines fall off the front
+    lines: Deque[Tuple[bool, str]] = field(
+        default_factory=lambda: collections.deque(maxlen=OUTPUT_LINES)
+    )
+    partial: Dict[bool, str] = field(default_factory=dict)
+    decoders: Dict[bool, codecs.IncrementalDecoder] = field(default_factory=dict)
+    version: int = 0  # bumped on every change so the output pad can skip re-rendering
+
+    @property
+    def running(self) -> bool:
+        return self.returncode is None
+
+    @property
+    def duration(self) -> float:
+        return (self.ended or time.monotonic()) - self.started
+
+    @property
+    def status(self) -> str:
+        if self.running:
+            return "cancel…" if self.cancelled_at else "running"
+        if self.cancelled_at:
+            return "cancelled"
+        return "ok" if self.returncode == 0 else f"exit {self.returncode}"
+
+
+def clean_line(text: str) -> str:
+    """Strip colour codes and carriage-return progress redraws, expand tabs."""
+    text = ANSI_RE.sub("", text.rstrip("\r"))
+    return text.rsplit("\r", 1)[-1].expandtabs(4)
+
+
+def fmt_duration(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    minutes, seconds = divmod(int(seconds), 60)
+    if minutes < 60:
+        return f"{minutes}m{seconds:02d}s"
+    return f"{minutes // 60}h{minutes % 60:02d}m"
+
+
+class JobManager:
+    """
+    Start shell commands and collect their output without ever blocking.
+
+    Every job gets its own process group (so cancel reaches pipelines and
+    children) and its stdout/stderr pipes are registered, non-blocking, with a
+    single selector. `poll()` drains whatever is readable and reaps finished
+    processes; the UI calls it between keypresses.
+    """
+
+    def __init__(self) -> None:
+        self.selector = selectors.DefaultSelector()
+        self.jobs: List[Job] = []
+        self._next_id = 1
+
+    def start(self, label: str, cmd: str) -> Job:
+        proc = subprocess.Popen(
+            cmd,
+            shell=True,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+        job = Job(self._next_id, label, cmd, proc)
+        self._next_id += 1
+        for is_err, stream in ((False, proc.stdout), (True, proc.stderr)):
+            os.set_blocking(stream.fileno(), False)
+            job.decoders[is_err] = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            self.selector.register(stream, selectors.EVENT_READ, (job, is_err))
+        self.jobs.append(job)
+        self._trim()
+        return job
+
+    def poll(self, timeout: float = 0.0) -> bool:
+        """
+        Read available output and reap exited jobs.
+
+        Parameters
+        ----------
+        timeout : float
+            Seconds to wait for output; 0 returns immediately.
+
+        Returns
+        -------
+        bool
+            True if any job gained output or changed state.
+        """
+        changed = False
+        if self.selector.get_map():
+            for key, _ in self.selector.select(timeout):
+                job, is_err = key.data
+                try:
+                    chunk = os.read(key.fd, 65536)
+                except BlockingIOError:
+                    continue
+                if chunk:
+                    self._feed(job, is_err, job.decoders[is_err].decode(chunk))
+                else:
+                    self.selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    rest = job.decoders[is_err].decode(b"", final=True)
+                    if rest or is_err in job.partial:
+                        self._feed(job, is_err, rest + "\n")
+                    self._note_sudo(job)  # stderr may drain after the exit was seen
+                changed = True
+        elif timeout > 0:
+            time.sleep(timeout)  # no pipes left to wait on; don't spin while jobs exit
+
+        now = time.monotonic()
+        for job in self.jobs:
+            if not job.running:
+                continue
+            if job.proc.poll() is not None:
+                job.returncode = job.proc.returncode
+                job.ended = now
+                self._note_sudo(job)
+                job.version += 1
+                changed = True
+            elif job.cancelled_at and now - job.cancelled_at > CANCEL_GRACE_S:
+                self._signal(job, signal.SIGKILL)
+        return changed
+
+    def cancel(self, job: Job) -> None:
+        if job.running and not job.cancelled_at:
+            job.cancelled_at = time.monotonic()
+            job.version += 1
+            self._signal(job, signal.SIGTERM)
+
+    def running(self) -> List[Job]:
+        return [job for job in self.jobs if job.running]
+
+    def shutdown(self) -> None:
+        """Cancel everything still running and wait (bounded) for it to exit."""
+        for job in self.running():
+            self.cancel(job)
+        deadline = time.monotonic() + CANCEL_GRACE_S + 1
+        while self.running() and time.monotonic() < deadline:
+            self.poll(0.1)
+
+    def _feed(self, job: Job, is_err: bool, text: str) -> None:
+        pieces = (job.partial.pop(is_err, "") + text).split("\n")
+        if pieces[-1]:
+            job.partial[is_err] = pieces[-1]
+        for piece in pieces[:-1]:
+            job.lines.append((is_err, clean_line(piece)))
+        job.version += 1
+
+    def _note_sudo(self, job: Job) -> None:
+        """Explain a failed job whose sudo could not prompt (jobs have no tty)."""
+        if not job.returncode or (True, SUDO_HINT) in job.lines:
+            return
+        if any(is_err and SUDO_DENIED_RE.search(line) for is_err, line in job.lines):
+            job.lines.append((True, SUDO_HINT))
+            job.version += 1
+
+    def _signal(self, job: Job, signum: int) -> None:
+        try:
+            os.killpg(job.proc.pid, signum)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def _trim(self) -> None:
+        finished = [job for job in self.jobs if not job.running]
+        for job in finished[:-JOB_HISTORY] if len(finished) > JOB_HISTORY else []:
+            self.jobs.remove(job)
+
+
+# --------------------------------------------------------------------------- #
+# CodeWalker dashboard
+# --------------------------------------------------------------------------- #
+
+class ActionRow(NamedTuple):
+    ts: float
+    run_id: Optional[int]
+    file_id: Optional[int]
+    model: str
+    backend: str
+    status: str
+    tokens_out: int
+    latency_ms: int
+
+
+def codewalker_db_path() -> str:
+    """db_path from codewalker.json, falling back to the default location."""
+    try:
+        with open(CODEWALKER_CONFIG, "r", encoding="utf-8") as fh:
+            return json.load(fh).get("db_path") or CODEWALKER_DB
+    except (OSError, ValueError):
+        return CODEWALKER_DB
+
+
+def parse_ts(value: Optional[str]) -> float:
+    """codewalker stores local ISO timestamps (human_ts); 0.0 if unparsable."""
+    try:
+        return dt.datetime.fromisoformat(value).timestamp() if value else 0.0
+    except ValueError:
+        return 0.0
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(pct / 100.0 * len(values)) - 1)]
+
+
+class WalkerStats:
+    """
+    Incremental, read-only view of codewalker.db.
+
+    Actions are fetched by rowid (`id > last seen`) into an in-memory window
+    covering DASH_WINDOW_S, so a refresh reads only rows written since the
+    previous one plus two indexed lookups (pending queue, latest run). The
+    connection is opened with mode=ro and never writes.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+        self.last_id = 0
+        self.window: Deque[ActionRow] = collections.deque()
+        self.queue_depth = 0
+        self.run: Optional[tuple] = None  # (id, started_at, finished_at, host, pid)
+        self.error: Optional[str] = None
+        self.updated = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=1.0)
+        newest = conn.execute("SELECT MAX(id) FROM actions").fetchone()[0] or 0
+        self.last_id = max(0, newest - DASH_SEED_ROWS)
+        self.window.clear()
+        return conn
+
+    def refresh(self) -> None:
+        self.updated = time.monotonic()
+        try:
+            if self.conn is None:
+                self.conn = self._connect()
+            rows = self.conn.execute(
+                "SELECT id, run_id, file_id, COALESCE(model, ''), COALESCE(backend, ''), "
+                "COALESCE(status, ''), COALESCE(tokens_out, 0), COALESCE(latency_ms, 0), created_at "
+                "FROM actions WHERE id > ? ORDER BY id",
+                (self.last_id,),
+            ).fetchall()
+            for row in rows:
+                self.window.append(ActionRow(parse_ts(row[8]), *row[1:8]))
+            if rows:
+                self.last_id = rows[-1][0]
+            cutoff = time.time() - DASH_WINDOW_S
+            while self.window and self.window[0].ts < cutoff:
+                self.window.popleft()
+
+            self.queue_depth = self.conn.execute(
+                "SELECT COUNT(*) FROM queued_files WHERE status='pending'"
+            ).fetchone()[0]
+            self.run = self.conn.execute(
+                "SELECT id, started_at, finished_at, host, pid FROM runs ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+            self.error = None
+        except sqlite3.Error as exc:
+            self.error = f"{self.path}: {exc}"
+            if self.conn is not None:
+                self.conn.close()
+            self.conn = None
+
+    def run_line(self) -> str:
+        if not self.run:
+            return "No runs recorded"
+        run_id, started, finished, host, pid = self.run
+        if finished:
+            return f"Idle – last run #{run_id} finished {finished}"
+        state = "running"
+        if host == socket.gethostname() and pid:
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                state = "stale (process gone)"
+            except PermissionError:
+                pass
+        done = sum(1 for row in self.window if row.run_id == run_id)
+        elapsed = fmt_duration(max(0.0, time.time() - parse_ts(started)))
+        return f"Run #{run_id} {state} {elapsed} on {host} pid {pid} – {done} action(s)"
+
+    def model_rows(self) -> List[Tuple[str, int, float, float, float, float]]:
+        """[(model/backend, actions, tok/s, p50 s, p95 s, error %)] busiest first."""
+        groups: Dict[str, List[ActionRow]] = {}
+        for row in self.window:
+            if row.status == "dedup":
+                continue
+            groups.setdefault(f"{row.model or '?'} / {row.backend or '?'}", []).append(row)
+        result = []
+        for name, rows in groups.items():
+            timed = [row for row in rows if row.status == "ok" and row.latency_ms > 0]
+            latencies = sorted(row.latency_ms / 1000.0 for row in timed)
+            seconds = sum(latencies)
+            tok_s = sum(row.tokens_out for row in timed) / seconds if seconds else 0.0
+            errors = sum(1 for row in rows if row.status != "ok")
+            result.append((
+                name, len(rows), tok_s,
+                percentile(latencies, 50), percentile(latencies, 95),
+                100.0 * errors / len(rows),
+            ))
+        return sorted(result, key=lambda item: -item[1])
+
+
+def draw_dashboard(win, stats: WalkerStats) -> None:
+    """
+    Render the CodeWalker dashboard into the right-hand window.
+
+    Parameters
+    ----------
+    win : curses.window
+        The right column window.
+    stats : WalkerStats
+        Source of the numbers; refreshed by the main loop, not here.
+    """
+    height, width = win.getmaxyx()
+    span = width - 1
+
+    def put(y: int, text: str, attr: int = 0) -> None:
+        if y < height:
+            win.addnstr(y, 0, text, span, attr)
+
+    put(0, f"CodeWalker – last {DASH_WINDOW_S // 60} min", curses.color_pair(2))
+    if stats.error:
+        put(1, stats.error, curses.color_pair(3))
+        return
+
+    rows = [row for row in stats.window if row.status != "dedup"]
+    errors = sum(1 for row in rows if row.status != "ok")
+    files = len({row.file_id for row in stats.window})
+    rate = f"{100.0 * errors / len(rows):.1f}%" if rows else "–"
+    put(1, f"Queue {stats.queue_depth} pending   Files/h {files}   Errors {errors}/{len(rows)} ({rate})")
+    put(2, stats.run_line(), curses.color_pair(4) if stats.run and not stats.run[2] else 0)
+
+    latencies = sorted(row.latency_ms / 1000.0 for row in rows if row.status == "ok" and row.latency_ms > 0)
+    if latencies:
+        put(3, "Latency  p50 {:.1f}s  p90 {:.1f}s  p99 {:.1f}s  max {:.1f}s".format(
+            percentile(latencies, 50), percentile(latencies, 90),
+            percentile(latencies, 99), latencies[-1],
+        ))
+
+    put(5, f"{'model / backend':<28} {'n':>5} {'tok/s':>7} {'p50':>6} {'p95':>6} {'err':>6}", curses.A_BOLD)
+    y = 6
+    for name, count, tok_s, p50, p95, err in stats.model_rows():
+        attr = curses.color_pair(3) if err >= 50 else 0
+        put(y, f"{name[:28]:<28} {count:>5} {tok_s:>7.1f} {p50:>5.1f}s {p95:>5.1f}s {err:>5.1f}%", attr)
+        y += 1
+    put(height - 1, f"{stats.path}  (every {DASH_REFRESH_S:.0f}s, rows up to #{stats.last_id})", curses.color_pair(1))
+
+
+# --------------------------------------------------------------------------- #
+# Drawing
+# --------------------------------------------------------------------------- #
+
+BODY_TOP = 3  # rows above the menu / right column (title, filter line)
+
+
+class MenuView:
+    """
+    The menu, rendered once onto a pad.
+
+    Moving the selection repaints just the two affected pad rows, and
+    scrolling only changes which slice of the pad is copied to the screen,
+    so every entry is reachable however small the terminal is. A filter
+    rebuilds the pad from the matching entries.
+    """
+
+    def __init__(self, commands: List[Command]) -> None:
+        self.commands = commands
+        self.filter = ""
+        self.visible: List[int] = list(range(len(commands)))
+        self.selected = 0  # index into `visible`
+        self.top = 0
+        self.pad = None
+        self._drawn: Optional[int] = None
+
+    def set_filter(self, text: str) -> None:
+        """Keep entries whose label or command contains every word of `text`."""
+        self.filter = text
+        terms = text.lower().split()
+        self.visible = [
+            idx for idx, (label, cmd) in enumerate(self.commands)
+            if all(term in label.lower() or term in cmd.lower() for term in terms)
+        ]
+        self.selected = 0
+        self.top = 0
+        self.pad = None
+
+    def move(self, delta: int) -> bool:
+        target = max(0, min(len(self.visible) - 1, self.selected + delta))
+        if target == self.selected or not self.visible:
+            return False
+        self.selected = target
+        return True
+
+    def current(self) -> Optional[Command]:
+        if not self.visible:
+            return None
+        return self.commands[self.visible[self.selected]]
+
+    def _draw_row(self, row: int) -> None:
+        label, _ = self.commands[self.visible[row]]
+        self.pad.move(row, 0)
+        self.pad.clrtoeol()
+        attr = curses.A_REVERSE if row == self.selected else 0
+        self.pad.addnstr(row, 2, label, MENU_WIDTH - 3, attr)
+
+    def show(self, rows: int) -> None:
+        """Update damaged pad rows, scroll the selection into view, and queue
+        the visible slice for the next doupdate()."""
+        if self.pad is None:
+            # At least a screenful, so a short filtered list blanks what was below it
+            self.pad = curses.newpad(max(rows, len(self.visible)), MENU_WIDTH)
+            for row in range(len(self.visible)):
+                self._draw_row(row)
+        elif self._drawn != self.selected:
+            if self._drawn is not None and self._drawn < len(self.visible):
+                self._draw_row(self._drawn)
+            if self.visible:
+                self._draw_row(self.selected)
+        self._drawn = self.selected
+
+        if self.selected < self.top:
+            self.top = self.selected
+        elif self.selected >= self.top + rows:
+            self.top = self.selected - rows + 1
+        self.pad.touchwin()
+        self.pad.noutrefresh(self.top, 0, BODY_TOP, 0, BODY_TOP + rows - 1, MENU_WIDTH - 1)
+
+
+def draw_header(win, menu: MenuView, filtering: bool) -> None:
+    height, width = win.getmaxyx()
+    title = "🛠️ T5600 AI Control Panel"
+    win.addnstr(1, max(0, (width - len(title)) // 2), title, width - 1, curses.color_pair(2))
+    if filtering or menu.filter:
+        line = f"/{menu.filter}" + ("_" if filtering else "")
+        win.addnstr(2, 2, line, MENU_WIDTH - 3, curses.color_pair(4))
+    position = f"{menu.selected + 1 if menu.visible else 0}/{len(menu.visible)}"
+    if len(menu.visible) != len(menu.commands):
+        position += f" of {len(menu.commands)}"
+    win.addnstr(2, max(0, MENU_WIDTH - len(position) - 2), position, width - 1)
+
+
+def draw_jobs(win, jobs: JobManager, shown: Optional[Job]) -> int:
+    """
+    Render the job list at the top of the right column.
+
+    Returns
+    -------
+    int
+        The first free row below the list.
+    """
+    span = win.getmaxyx()[1] - 1
+    win.addnstr(0, 0, "Jobs", span, curses.color_pair(2))
+    y = 1
+    for job in jobs.jobs[-JOB_ROWS:]:
+        colour = curses.color_pair(4) if job.running else (
+            curses.color_pair(1) if job.returncode == 0 else curses.color_pair(3)
+        )
+        row = f"#{job.id:<3} {job.status:<10} {fmt_duration(job.duration):>7}  {job.label.strip()}"
+        attr = colour | (curses.A_REVERSE if job is shown else 0)
+        win.addnstr(y, 0, row, span, attr)
+        y += 1
+    return max(y, 2) + 1
+
+
+class OutputPane:
+    """
+    Scrollable view of one job's ring buffer, backed by a curses pad.
+
+    The pad is only rebuilt when the job's `version` or the pane width
+    changes; scrolling just refreshes a different slice of it.
+    """
+
+    def __init__(self) -> None:
+        self.pad = None
+        self._key: Optional[Tuple[int, int, int]] = None
+        self.scroll: Optional[int] = None  # None = follow the tail
+        self.rows = 1
+
+    def render(self, job: Job, width: int) -> None:
+        key = (job.id, job.version, width)
+        if key == self._key:
+            return
+        self._key = key
+        lines = list(job.lines) + [(is_err, clean_line(text)) for is_err, text in job.partial.items()]
+        self.pad = curses.newpad(max(1, len(lines)), max(1, width))
+        for y, (is_err, text) in enumerate(lines):
+            self.pad.addnstr(y, 0, text, width - 1, curses.color_pair(3) if is_err else 0)
+
+    def show(self, top: int, left: int, bottom: int, right: int) -> None:
+        if self.pad is None or bottom < top:
+            return
+        total = self.pad.getmaxyx()[0]
+        self.rows = rows = bottom - top + 1
+        last = max(0, total - rows)
+        first = last if self.scroll is None else max(0, min(self.scroll, last))
+        self.pad.touchwin()  # the right column was just redrawn underneath it
+        self.pad.noutrefresh(first, 0, top, left, bottom, right)
+
+    def page(self, direction: int) -> None:
+        total = self.pad.getmaxyx()[0] if self.pad else 0
+        last = max(0, total - self.rows)
+        delta = direction * max(1, self.rows - 1)
+        current = last if self.scroll is None else self.scroll
+        target = max(0, current + delta)
+        self.scroll = None if target >= last else target
+
+
+def draw_output(win, pane: OutputPane, job: Optional[Job], top: int) -> None:
+    """Output header at row `top` of the right window; the pad itself is
+    copied on top by Screen.paint once the window has been flushed."""
+    width = win.getmaxyx()[1]
+    if top >= win.getmaxyx()[0] - 1:
+        return
+    header = f"Output #{job.id}: {job.cmd}" if job else "Output"
+    if job and pane.scroll is not None:
+        header = "[scrolled] " + header
+    win.addnstr(top, 0, header, width - 1, curses.color_pair(2))
+    if job:
+        pane.render(job, width - 1)
+
+
+class Screen:
+    """
+    One curses window per region plus a set of damaged regions.
+
+    Callers mark regions dirty ("header", "menu", "right", "status"); `paint`
+    redraws only those and flushes everything with a single doupdate().
+    """
+
+    REGIONS = {"header", "menu", "right", "status"}
+
+    def __init__(self, stdscr) -> None:
+        self.stdscr = stdscr
+        self.layout()
+
+    def layout(self) -> None:
+        height, width = self.stdscr.getmaxyx()
+        self.too_small = height < BODY_TOP + 3 or width < MENU_WIDTH + 20
+        self.body_rows = max(1, height - BODY_TOP - 1)
+        self.stdscr.erase()
+        self.stdscr.noutrefresh()
+        if self.too_small:
+            self.stdscr.addnstr(0, 0, "Terminal too small", max(1, width - 1))
+            self.stdscr.noutrefresh()
+            self.dirty: set = set()
+            return
+        self.header = curses.newwin(BODY_TOP, width, 0, 0)
+        self.right = curses.newwin(self.body_rows, width - MENU_WIDTH, BODY_TOP, MENU_WIDTH)
+        self.status = curses.newwin(1, width, height - 1, 0)
+        self.dirty = set(self.REGIONS)
+
+    def damage(self, *regions: str) -> None:
+        self.dirty.update(regions)
+
+    def paint(self, menu: MenuView, filtering: bool, jobs: JobManager, shown: Optional[Job],
+              pane: OutputPane, stats: Optional[WalkerStats], status: str) -> None:
+        if self.too_small:
+            self.dirty.clear()
+            curses.doupdate()
+            return
+        if "header" in self.dirty:
+            self.header.erase()
+            draw_header(self.header, menu, filtering)
+            self.header.noutrefresh()
+        if "right" in self.dirty:
+            self.right.erase()
+            if stats is not None:
+                draw_dashboard(self.right, stats)
+                self.right.noutrefresh()
+            else:
+                output_top = draw_jobs(self.right, jobs, shown)
+                draw_output(self.right, pane, shown, output_top)
+                self.right.noutrefresh()
+                if shown is not None:
+                    # Pads take screen coordinates
+                    origin_y, origin_x = self.right.getbegyx()
+                    height, width = self.right.getmaxyx()
+                    pane.show(origin_y + output_top + 1, origin_x, origin_y + height - 1, origin_x + width - 2)
+        if "menu" in self.dirty:
+            menu.show(self.body_rows)
+        if "status" in self.dirty:
+            self.status.erase()
+            self.status.addnstr(0, 0, status, self.status.getmaxyx()[1] - 1, curses.color_pair(1))
+            self.status.noutrefresh()
+        self.dirty.clear()
+        curses.doupdate()
+
+
+HELP = "Enter: run  /: filter  Tab: next job  c: cancel  PgUp/PgDn: scroll  d: dashboard  q: quit"
+
+
+def main(stdscr: curses.window) -> None:
+    """
+    Main event loop for the panel.
+
+    The loop wakes every 100 ms (`stdscr.timeout`) to drain job output and
+    repaints only damaged regions: the menu on selection/filter changes, the
+    right column when a job produces output or changes state (and once a
+    second while jobs run), the dashboard on each poll.
+
+    Parameters
+    ----------
+    stdscr : curses.window
+        The main window object.
+    """
+    # Initialise colour pairs (foreground, background)
+    curses.start_color()
+    curses.init_pair(1, curses.COLOR_WHITE, curses.COLOR_BLACK)  # default
+    curses.init_pair(2, curses.COLOR_GREEN, curses.COLOR_BLACK)  # title
+    curses.init_pair(3, curses.COLOR_RED, curses.COLOR_BLACK)    # stderr / failed
+    curses.init_pair(4, curses.COLOR_YELLOW, curses.COLOR_BLACK) # running / filter
+    try:
+        curses.curs_set(0)
+    except curses.error:
+        pass
+    stdscr.timeout(100)
+    if hasattr(curses, "set_escdelay"):
+        curses.set_escdelay(50)  # Esc clears the filter / quits without a 1s lag
+
+    commands, error = load_commands()
+    menu = MenuView(commands)
+    screen = Screen(stdscr)
+    jobs = JobManager()
+    pane = OutputPane()
+    stats: Optional[WalkerStats] = None  # set while the dashboard is shown
+    shown: Optional[Job] = None
+    status = error or HELP
+    filtering = False
+    confirm_quit = False
+    last_tick = 0.0
+
+    try:
+        while True:
+            if screen.dirty:
+                screen.paint(menu, filtering, jobs, shown, pane, stats, status)
+
+            key = stdscr.getch()
+            if jobs.poll(0) and stats is None:
+                screen.damage("right")
+            if jobs.running() and time.monotonic() - last_tick >= 1.0:
+                last_tick = time.monotonic()
+                if stats is None:
+                    screen.damage("right")
+            if stats is not None and time.monotonic() - stats.updated >= DASH_REFRESH_S:
+                stats.refresh()
+                screen.damage("right")
+            if key == -1:
+                continue
+
+            previous_status = status
+            if key not in (ord("q"), 27):
+                confirm_quit = False
+
+            if key == curses.KEY_RESIZE:
+                screen.layout()
+                menu.pad = None
+            elif filtering and key in (27, ord("\n"), curses.KEY_ENTER):
+                filtering = False
+                screen.damage("header")
+                if key == 27:
+                    menu.set_filter("")
+                    screen.damage("menu")
+                    continue
+                # Enter falls through to run the highlighted match
+                key = ord("\n")
+            elif filtering and key in (curses.KEY_BACKSPACE, 127, 8):
+                menu.set_filter(menu.filter[:-1])
+                screen.damage("header", "menu")
+                continue
+            elif filtering and 32 <= key < 127:
+                menu.set_filter(menu.filter + chr(key))
+                screen.damage("header", "menu")
+                continue
+
+            if key in (curses.KEY_UP, ord("k")):
+                if menu.move(-1):
+                    screen.damage("menu", "header")
+            elif key in (curses.KEY_DOWN, ord("j")):
+                if menu.move(1):
+                    screen.damage("menu", "header")
+            elif key == ord("/"):
+                filtering = True
+                screen.damage("header")
+            elif key in (ord("\n"), curses.KEY_ENTER):
+                entry = menu.current()
+                if entry is not None:
+                    label, cmd = entry
+                    cmd = expand_command(cmd)
+                    try:
+                        shown = jobs.start(label, cmd)
+                        pane.scroll = None
+                        status = f"Started #{shown.id}: {cmd}"
+                    except OSError as exc:
+                        status = f"Failed to start: {exc}"
+                    screen.damage("right")
+            elif key == ord("\t") and jobs.jobs:
+                index = jobs.jobs.index(shown) if shown in jobs.jobs else -1
+                shown = jobs.jobs[(index + 1) % len(jobs.jobs)]
+                pane.scroll = None
+                screen.damage("right")
+            elif key == ord("d"):
+                if stats is None:
+                    stats = WalkerStats(codewalker_db_path())
+                    stats.refresh()
+                else:
+                    if stats.conn is not None:
+                        stats.conn.close()
+                    stats = None
+                screen.damage("right")
+            elif key == ord("c") and shown is not None:
+                jobs.cancel(shown)
+                status = f"Cancelling #{shown.id}"
+                screen.damage("right")
+            elif key in (curses.KEY_PPAGE, curses.KEY_NPAGE, curses.KEY_HOME, curses.KEY_END):
+                if key == curses.KEY_PPAGE:
+                    pane.page(-1)
+                elif key == curses.KEY_NPAGE:
+                    pane.page(1)
+                else:
+                    pane.scroll = 0 if key == curses.KEY_HOME else None
+                screen.damage("right")
+            elif key in (ord("q"), 27):  # 'q' or ESC to quit
+                if menu.filter and key == 27:
+                    menu.set_filter("")
+                    screen.damage("header", "menu")
+                    continue
+                running = len(jobs.running())
+                if running and not confirm_quit:
+                    confirm_quit = True
+                    status = f"{running} job(s) still running – press q again to cancel them and quit"
+                else:
+                    break
+            if status != previous_status:
+                screen.damage("status")
+    finally:
+        jobs.shutdown()
+
+
+# --------------------------------------------------------------------------- #
+# Entry point
+# --------------------------------------------------------------------------- #
+
+if __name__ == "__main__":
+    curses.wrapper(main)